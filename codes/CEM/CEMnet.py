@@ -9,15 +9,24 @@ tf_loaded,pytorch_loaded = False,False
 try:
     import torch
     import torch.nn as nn
+    import torch.fft
+    from typing import Optional,Tuple
     pytorch_loaded = True
 except:
     pass
 import copy
+import math
+import os
+import hashlib
 from CEM.imresize_CEM import imresize,calc_strides
+from utils.cache import LRU_Cache
 import collections
 
 class CEMnet:
     NFFT_add = 36
+    PRECOMPUTATION_CONF_FIELDS = ['lower_magnitude_bound','filter_pertubation_limit','desired_inv_hTh_energy_portion']
+    PRECOMPUTED_CACHE_SIZE = 8
+    precomputed = LRU_Cache(PRECOMPUTED_CACHE_SIZE) # In-memory cache of precomputed filters and margins, shared by all instances
 
     def __init__(self,conf,upscale_kernel=None):
         self.conf = conf
@@ -27,16 +36,65 @@ class CEMnet:
         # if isinstance(upscale_kernel, torch.Tensor):
         #     upscale_kernel = np.squeeze(upscale_kernel.data.cpu().numpy())
         self.ds_kernel = Return_kernel(self.ds_factor,upscale_kernel=upscale_kernel)
-        self.ds_kernel_invalidity_half_size_LR = self.Return_Invalid_Margin_Size_in_LR('ds_kernel',self.conf.filter_pertubation_limit)
-        self.compute_inv_hTh()
+        self.imresize_kernel = upscale_kernel # Passed to imresize by the numpy methods (e.g. Enforce_DT_on_Image_Pair)
+        if not self.Load_Precomputed():
+            self.ds_kernel_invalidity_half_size_LR = self.Return_Invalid_Margin_Size_in_LR('ds_kernel',self.conf.filter_pertubation_limit)
+            self.compute_inv_hTh()
+            self.Save_Precomputed()
         self.invalidity_margins_LR = 2* self.ds_kernel_invalidity_half_size_LR + self.inv_hTh_invalidity_half_size
         self.invalidity_margins_HR = self.ds_factor * self.invalidity_margins_LR
 
+    def Precomputation_Key(self):
+        # The precomputed filters and margins are fully determined by the downscaling kernel (which already accounts for the scale factor) and the following conf fields:
+        key = hashlib.sha1(self.ds_kernel.tobytes())
+        key.update(str([self.ds_kernel.shape,self.NFFT_add]+[getattr(self.conf,field) for field in self.PRECOMPUTATION_CONF_FIELDS]).encode())
+        return 'x%d_%s'%(self.ds_factor,key.hexdigest())
+
+    def Precomputation_Cache_Path(self):
+        if 'precomputation_cache_dir' not in self.conf.__dict__ or self.conf.precomputation_cache_dir is None:
+            return None
+        return os.path.join(os.path.expanduser(self.conf.precomputation_cache_dir),self.Precomputation_Key()+'.npz')
+
+    def Load_Precomputed(self):
+        def Load_From_Disk():
+            cache_path = self.Precomputation_Cache_Path()
+            if cache_path is None or not os.path.isfile(cache_path):
+                return None
+            try:
+                return dict(np.load(cache_path))
+            except Exception as e:
+                print('Failed loading precomputed CEM filters from %s (%s). Recomputing...'%(cache_path,e))
+                return None
+        loaded = CEMnet.precomputed.get(self.Precomputation_Key(),Load_From_Disk)
+        if loaded is None:
+            return False
+        assert np.all(loaded['ds_kernel']==self.ds_kernel),'Precomputed CEM filters key collision'
+        self.inv_hTh = 1*loaded['inv_hTh']
+        self.inv_hTh_invalidity_half_size = int(loaded['inv_hTh_invalidity_half_size'])
+        self.ds_kernel_invalidity_half_size_LR = int(loaded['ds_kernel_invalidity_half_size_LR'])
+        return True
+
+    def Save_Precomputed(self):
+        precomputed = {'ds_kernel':self.ds_kernel,'inv_hTh':self.inv_hTh,'inv_hTh_invalidity_half_size':self.inv_hTh_invalidity_half_size,
+                       'ds_kernel_invalidity_half_size_LR':self.ds_kernel_invalidity_half_size_LR}
+        CEMnet.precomputed.put(self.Precomputation_Key(),precomputed)
+        cache_path = self.Precomputation_Cache_Path()
+        if cache_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(cache_path),exist_ok=True)
+            # Writing to a temporary file first, so that concurrent processes never read a partially written file:
+            temp_path = '%s.%d.tmp.npz'%(cache_path[:-len('.npz')],os.getpid())
+            np.savez(temp_path,**precomputed)
+            os.replace(temp_path,cache_path)
+        except OSError as e:
+            print('Failed saving precomputed CEM filters to %s (%s)'%(cache_path,e))
+
     def Return_Invalid_Margin_Size_in_LR(self,filter,max_allowed_perturbation):
         TEST_IM_SIZE = 100
         assert filter in ['ds_kernel','inv_hTh']
         if filter=='ds_kernel':
-            output_im = imresize(np.ones([self.ds_factor*TEST_IM_SIZE, self.ds_factor*TEST_IM_SIZE]),[1/self.ds_factor],use_zero_padding=True)
+            output_im = imresize(np.ones([self.ds_factor*TEST_IM_SIZE, self.ds_factor*TEST_IM_SIZE]),[1/self.ds_factor],use_zero_padding=True,kernel=self.imresize_kernel)
         elif filter=='inv_hTh':
             output_im = conv2(np.ones([TEST_IM_SIZE,TEST_IM_SIZE]), self.inv_hTh,mode='same')
         output_im /= output_im[int(TEST_IM_SIZE/2),int(TEST_IM_SIZE/2)]
@@ -60,17 +118,17 @@ class CEMnet:
     def DT_Satisfying_Upscale(self,LR_image):
         margin_size = 2*self.inv_hTh_invalidity_half_size+self.ds_kernel_invalidity_half_size_LR
         LR_image = Pad_Image(LR_image,margin_size)
-        HR_image = imresize(np.stack([conv2(LR_image[:,:,channel_num],self.inv_hTh,mode='same') for channel_num in range(LR_image.shape[-1])],-1),scale_factor=[self.ds_factor])
+        HR_image = imresize(np.stack([conv2(LR_image[:,:,channel_num],self.inv_hTh,mode='same') for channel_num in range(LR_image.shape[-1])],-1),scale_factor=[self.ds_factor],kernel=self.imresize_kernel)
         return Unpad_Image(HR_image,self.ds_factor*margin_size)
 
     def WrapArchitecture_PyTorch(self,generated_image=None,training_patch_size=None,only_padders=False):
         assert pytorch_loaded,'Failed to load PyTorch - Necessary for this function of CEM'
-        invalidity_margins_4_test_LR = self.invalidity_margins_LR
-        invalidity_margins_4_test_HR = self.ds_factor*invalidity_margins_4_test_LR
+        invalidity_margins_4_test_LR = int(self.invalidity_margins_LR)
+        invalidity_margins_4_test_HR = int(self.ds_factor*invalidity_margins_4_test_LR)
         self.LR_padder = torch.nn.ReplicationPad2d((invalidity_margins_4_test_LR, invalidity_margins_4_test_LR,invalidity_margins_4_test_LR, invalidity_margins_4_test_LR))
         self.HR_padder = torch.nn.ReplicationPad2d((invalidity_margins_4_test_HR, invalidity_margins_4_test_HR,invalidity_margins_4_test_HR, invalidity_margins_4_test_HR))
-        self.HR_unpadder = lambda x: x[:, :, invalidity_margins_4_test_HR:-invalidity_margins_4_test_HR,invalidity_margins_4_test_HR:-invalidity_margins_4_test_HR]
-        self.LR_unpadder = lambda x:x[:,:,invalidity_margins_4_test_LR:-invalidity_margins_4_test_LR,invalidity_margins_4_test_LR:-invalidity_margins_4_test_LR]#Debugging tool
+        self.HR_unpadder = Unpadder(invalidity_margins_4_test_HR)
+        self.LR_unpadder = Unpadder(invalidity_margins_4_test_LR)#Debugging tool
         self.loss_mask = None
         if training_patch_size is not None:
             self.loss_mask = np.zeros([1,1,training_patch_size,training_patch_size])
@@ -78,7 +136,7 @@ class CEMnet:
             self.loss_mask[:,:,invalidity_margins:-invalidity_margins,invalidity_margins:-invalidity_margins] = 1
             assert np.mean(self.loss_mask) > 0, 'Loss mask completely nullifies image.'
             print('Using only only %.3f of patch area for learning. The rest is considered to have boundary effects' % (np.mean(self.loss_mask)))
-            self.loss_mask = torch.from_numpy(self.loss_mask).type(torch.cuda.FloatTensor)
+            self.loss_mask = torch.from_numpy(self.loss_mask).float()
         if only_padders:
             return
         else:
@@ -88,6 +146,8 @@ class CEMnet:
 
     def Mask_Invalid_Regions_PyTorch(self,im1,im2):
         assert self.loss_mask is not None,'Mask not defined, probably didn''t pass patch size'
+        if self.loss_mask.device!=im1.device:
+            self.loss_mask = self.loss_mask.to(im1.device)
         return self.loss_mask*im1,self.loss_mask*im2
 
     def WrapArchitecture(self,model,unpadded_input_t,generated_image_t=None):
@@ -152,7 +212,7 @@ class CEMnet:
         return  HR_input-HR_projected_2_h_subspace+LR_source
 
     def Project_2_ortho_2_NS(self,HR_input):
-        downscaled_input = imresize(HR_input,scale_factor=[1/self.ds_factor])
+        downscaled_input = imresize(HR_input,scale_factor=[1/self.ds_factor],kernel=self.imresize_kernel)
         if downscaled_input.ndim<HR_input.ndim:#In case input was of size self.ds_factor in at least one of its axes:
             downscaled_input = np.reshape(downscaled_input,list(HR_input.shape[:2]//self.ds_factor)+([HR_input.shape[2]] if HR_input.ndim>2 else []))
         return self.DT_Satisfying_Upscale(downscaled_input)
@@ -239,76 +299,344 @@ class CEMnet:
                         initializer=tf.random_normal_initializer(stddev=np.sqrt(self.conf.init_variance / np.prod(downscale_antialiasing.get_shape().as_list()[0:3])))),strides=[1,1,1,1],padding='SAME'))
 
 class Filter_Layer(nn.Module):
-    def __init__(self,filter,pre_filter_func,post_filter_func=None):
+    FFT_COST_FACTOR = 24 # Rough (empirical, CPU) ratio between the per-element-per-log2(size) cost of an FFT and the cost of a single spatial multiply-accumulate
+    MAX_CACHED_SPECTRA = 8
+    __constants__ = ['FFT_COST_FACTOR'] # For TorchScript
+    __jit_ignored_attributes__ = ['kernel_spectra']
+    def __init__(self,filter,pre_filter=None,post_filter=None,filtering_mode='spatial'):
         super(Filter_Layer, self).__init__()
+        assert filtering_mode in ['spatial','FFT','auto']
         self.Filter_OP = nn.Conv2d(in_channels=3,out_channels=3,kernel_size=filter.shape,bias=False,groups=3)
-        self.Filter_OP.weight = nn.Parameter(data=torch.from_numpy(np.tile(np.expand_dims(np.expand_dims(filter, 0), 0), reps=[3, 1, 1, 1])).type(torch.cuda.FloatTensor), requires_grad=False)
+        self.Filter_OP.weight = nn.Parameter(data=torch.from_numpy(np.tile(np.expand_dims(np.expand_dims(filter, 0), 0), reps=[3, 1, 1, 1])).float(), requires_grad=False)
         self.Filter_OP.filter_layer = True
-        self.pre_filter_func = pre_filter_func
-        self.post_filter_func = (lambda x:x) if post_filter_func is None else post_filter_func
+        self.pre_filter = nn.Identity() if pre_filter is None else pre_filter
+        self.post_filter = nn.Identity() if post_filter is None else post_filter
+        self.filtering_mode = filtering_mode
+        self.kernel_spectra = {}
+    def forward(self, x):
+        return self.post_filter(self.Convolve(self.pre_filter(x)))
+
+    def Use_FFT(self,input:torch.Tensor,weight:torch.Tensor,stride:int):
+        if self.filtering_mode!='auto':
+            return self.filtering_mode=='FFT'
+        input_area = input.size(2)*input.size(3)
+        output_area = ((input.size(2)-weight.size(2))//stride+1)*((input.size(3)-weight.size(3))//stride+1)
+        spatial_cost = weight.size(0)*output_area*weight.size(2)*weight.size(3)
+        # Forward transform of the input and inverse transform of the output, both at input size (The kernel spectrum is cached):
+        fft_cost = self.FFT_COST_FACTOR*(input.size(1)+weight.size(0))*input_area*math.log(float(input_area))/math.log(2.)
+        return fft_cost<spatial_cost
+
+    def Kernel_Spectrum(self,input:torch.Tensor,weight:torch.Tensor):
+        # Correlating is convolving with the flipped kernel. Kernel spectra are cached per input size, since the FFT size should match the input size. The given weight may be derived
+        # from Filter_OP's weight on each call (e.g. Polyphase_Weight), so the key tracks Filter_OP's weight itself, whose version changes with in-place edits (e.g. load_state_dict):
+        input_size = [input.size(2),input.size(3)]
+        if not torch.jit.is_scripting(): # No caching in TorchScript
+            spectrum_key = (tuple(input_size),str(input.device),input.dtype,self.Filter_OP.weight._version,self.Filter_OP.weight.data_ptr())
+            if spectrum_key not in self.kernel_spectra:
+                if len(self.kernel_spectra)>=self.MAX_CACHED_SPECTRA:
+                    self.kernel_spectra = {}
+                self.kernel_spectra[spectrum_key] = torch.fft.rfft2(weight.flip([2,3]).to(input.device,input.dtype),s=input_size)
+            return self.kernel_spectra[spectrum_key]
+        return torch.fft.rfft2(weight.flip([2,3]).to(input.device,input.dtype),s=input_size)
+
+    def Convolve(self,input:torch.Tensor,weight:Optional[torch.Tensor]=None,stride:int=1):
+        # Valid (unpadded) depthwise correlation of input with weight (defaults to the Filter_OP weight), computed either spatially or in the Fourier domain:
+        if weight is None:
+            weight = self.Filter_OP.weight
+        if not self.Use_FFT(input,weight,stride):
+            return nn.functional.conv2d(input,weight,stride=stride,groups=self.Filter_OP.groups)
+        if input.dtype in [torch.float16,torch.bfloat16]:# Reduced precision FFTs are not supported on all devices and sizes, and would hardly save time anyway
+            input = input.float()
+        input_size = [input.size(2),input.size(3)]
+        kernel_spectrum = self.Kernel_Spectrum(input,weight)
+        input_spectrum = torch.fft.rfft2(input).unsqueeze(2)
+        output_spectrum = input_spectrum*kernel_spectrum.view([self.Filter_OP.groups,-1]+list(kernel_spectrum.size()[2:]))
+        output = torch.fft.irfft2(output_spectrum.view([input.size(0),-1]+list(output_spectrum.size()[3:])),s=input_size)
+        # The circular convolution wraps around only in the first kernel_size-1 rows and columns, which are exactly those the valid correlation discards:
+        return output[:,:,weight.size(2)-1::stride,weight.size(3)-1::stride]
+
+    def _apply(self,fn,*args,**kwargs):
+        self.kernel_spectra = {}
+        return super(Filter_Layer, self)._apply(fn,*args,**kwargs)
+
+class Polyphase_Upscale_Layer(Filter_Layer):
+    # Computes the zero-stuffing upscaling followed by an HR convolution with filter, as ds_factor**2 LR convolutions (one per output sub-pixel phase) whose outputs are
+    # interleaved using pixel shuffling. Only valid when the zero-stuffed image has zero rows and columns on all its edges (pre_stride>0 and post_stride>0), since
+    # then replication padding the zero-stuffed image is equivalent to zero padding it. The dense filter is kept in Filter_OP, so state_dict keys remain unchanged.
+    def __init__(self,filter,ds_factor,pre_stride,filtering_mode='spatial'):
+        super(Polyphase_Upscale_Layer, self).__init__(filter,filtering_mode=filtering_mode)
+        self.ds_factor = int(ds_factor)
+        padding = np.floor(np.array(filter.shape)/2).astype(np.int32)
+        self.weight_padding,self.input_padding,self.sub_filter_size = [],[],[]
+        for axis in [1,0]:# Ordered as expected by nn.functional.pad (last axis first)
+            # HR tap index for LR offset o and sub-pixel phase a is ds_factor*o+taps_offset-a:
+            taps_offset = int(pre_stride[axis]+padding[axis])
+            min_offset = -(taps_offset//self.ds_factor)
+            max_offset = (filter.shape[axis]-1-taps_offset+self.ds_factor-1)//self.ds_factor
+            self.sub_filter_size.insert(0,int(max_offset-min_offset+1))
+            first_tap = self.ds_factor*min_offset+taps_offset-(self.ds_factor-1)
+            self.weight_padding += [int(-first_tap),int(first_tap+self.ds_factor*self.sub_filter_size[0]-filter.shape[axis])]
+            self.input_padding += [int(-min_offset),int(max_offset)]
+
+    def Polyphase_Weight(self):
+        weight = nn.functional.pad(self.Filter_OP.weight,self.weight_padding)
+        weight = weight.view([weight.size(0),self.sub_filter_size[0],self.ds_factor,self.sub_filter_size[1],self.ds_factor]).flip([2,4])
+        return weight.permute(0,2,4,1,3).contiguous().view([-1,1]+self.sub_filter_size)
+
+    def forward(self, x):
+        return nn.functional.pixel_shuffle(self.Convolve(nn.functional.pad(x,self.input_padding),weight=self.Polyphase_Weight()),self.ds_factor)
+
+class Strided_Downscale_Layer(Filter_Layer):
+    # Computes the HR convolution followed by aliased downsampling as a single strided convolution, evaluating only the retained output samples.
+    def __init__(self,filter,ds_factor,pre_stride,pre_filter,filtering_mode='spatial'):
+        super(Strided_Downscale_Layer, self).__init__(filter,pre_filter=pre_filter,filtering_mode=filtering_mode)
+        self.ds_factor = int(ds_factor)
+        self.pre_stride = [int(val) for val in pre_stride]
+
+    def forward(self, x):
+        output_size = [val//self.ds_factor for val in x.size()[2:]]
+        output = self.Convolve(self.pre_filter(x)[:,:,self.pre_stride[0]:,self.pre_stride[1]:],stride=self.ds_factor)
+        return output[:,:,:output_size[0],:output_size[1]]
+
+class Aliased_Upscale_Layer(nn.Module):
+    # Zero-stuffing upscaling:
+    def __init__(self,ds_factor,pre_stride,post_stride):
+        super(Aliased_Upscale_Layer, self).__init__()
+        self.ds_factor = int(ds_factor)
+        self.padding = [int(pre_stride[1]),int(post_stride[1]),0,0,int(pre_stride[0]),int(post_stride[0])]
+
     def forward(self, x):
-        return self.post_filter_func(self.Filter_OP(self.pre_filter_func(x)))
+        return nn.functional.pad(x.unsqueeze(4).unsqueeze(3),self.padding).view([x.size(0),x.size(1),self.ds_factor*x.size(2),self.ds_factor*x.size(3)])
+
+class Aliased_Downscale_Layer(nn.Module):
+    # Sub-sampling, without anti-aliasing:
+    def __init__(self,ds_factor,pre_stride):
+        super(Aliased_Downscale_Layer, self).__init__()
+        self.ds_factor = int(ds_factor)
+        self.pre_stride = [int(val) for val in pre_stride]
+
+    def forward(self, x):
+        return x.view([x.size(0),x.size(1),x.size(2)//self.ds_factor,self.ds_factor,x.size(3)//self.ds_factor,self.ds_factor])[:,:,:,self.pre_stride[0],:,self.pre_stride[1]]
+
+class Unpadder(nn.Module):
+    def __init__(self,margin):
+        super(Unpadder, self).__init__()
+        self.margin = int(margin)
+
+    def forward(self, x):
+        return x[:,:,self.margin:-self.margin,self.margin:-self.margin]
 
 class CEM_PyTorch(nn.Module):
+    PRECISION_DTYPES = {'bf16':torch.bfloat16,'fp16':torch.float16}
     def __init__(self, CEMnet, generated_image):
         super(CEM_PyTorch, self).__init__()
-        self.ds_factor = CEMnet.ds_factor
-        self.conf = CEMnet.conf
+        self.ds_factor = int(CEMnet.ds_factor)
+        conf = CEMnet.conf
         self.generated_image_model = generated_image
+        self.num_latent_channels = int(getattr(generated_image,'num_latent_channels',0) or 0)
+        self.latent_upscale = int(getattr(generated_image,'upscale',self.ds_factor))
+        self.sigmoid_range_limit = bool(conf.sigmoid_range_limit)
+        self.input_range = [float(val) for val in conf.input_range] if 'input_range' in conf.__dict__ else [0.,1.]
+        self.range_span = self.input_range[1]-self.input_range[0]
         inv_hTh_padding = np.floor(np.array(CEMnet.inv_hTh.shape)/2).astype(np.int32)
-        Replication_Padder = nn.ReplicationPad2d((inv_hTh_padding[1],inv_hTh_padding[1],inv_hTh_padding[0],inv_hTh_padding[0]))
-        self.Conv_LR_with_Inv_hTh_OP = Filter_Layer(CEMnet.inv_hTh,pre_filter_func=Replication_Padder)
+        Replication_Padder = nn.ReplicationPad2d((int(inv_hTh_padding[1]),int(inv_hTh_padding[1]),int(inv_hTh_padding[0]),int(inv_hTh_padding[0])))
+        filtering_mode = conf.filtering_mode if 'filtering_mode' in conf.__dict__ else 'spatial'
+        self.Conv_LR_with_Inv_hTh_OP = Filter_Layer(CEMnet.inv_hTh,pre_filter=Replication_Padder,filtering_mode=filtering_mode)
         downscale_antialiasing = np.rot90(CEMnet.ds_kernel,2)
         upscale_antialiasing = CEMnet.ds_kernel*CEMnet.ds_factor**2
         pre_stride, post_stride = calc_strides(None, CEMnet.ds_factor)
-        Upscale_Padder = lambda x: nn.functional.pad(x,(pre_stride[1],post_stride[1],0,0,pre_stride[0],post_stride[0]))
-        Aliased_Upscale_OP = lambda x:Upscale_Padder(x.unsqueeze(4).unsqueeze(3)).view([x.size()[0],x.size()[1],CEMnet.ds_factor*x.size()[2],CEMnet.ds_factor*x.size()[3]])
         antialiasing_padding = np.floor(np.array(CEMnet.ds_kernel.shape)/2).astype(np.int32)
-        antialiasing_Padder = nn.ReplicationPad2d((antialiasing_padding[1],antialiasing_padding[1],antialiasing_padding[0],antialiasing_padding[0]))
-        self.Upscale_OP = Filter_Layer(upscale_antialiasing,pre_filter_func=lambda x:antialiasing_Padder(Aliased_Upscale_OP(x)))
-        Reshaped_input = lambda x:x.view([x.size()[0],x.size()[1],int(x.size()[2]/self.ds_factor),self.ds_factor,int(x.size()[3]/self.ds_factor),self.ds_factor])
-        Aliased_Downscale_OP = lambda x:Reshaped_input(x)[:,:,:,pre_stride[0],:,pre_stride[1]]
-        self.DownscaleOP = Filter_Layer(downscale_antialiasing,pre_filter_func=antialiasing_Padder,post_filter_func=lambda x:Aliased_Downscale_OP(x))
+        antialiasing_Padder = nn.ReplicationPad2d((int(antialiasing_padding[1]),int(antialiasing_padding[1]),int(antialiasing_padding[0]),int(antialiasing_padding[0])))
+        polyphase_scaling = 'polyphase_scaling' in conf.__dict__ and conf.polyphase_scaling
+        if polyphase_scaling and np.all(pre_stride>0) and np.all(post_stride>0):
+            self.Upscale_OP = Polyphase_Upscale_Layer(upscale_antialiasing,ds_factor=CEMnet.ds_factor,pre_stride=pre_stride,filtering_mode=filtering_mode)
+        else:# Replication padding of the zero-stuffed image does not amount to zero padding (e.g. for ds_factor 2), so using the HR convolution:
+            self.Upscale_OP = Filter_Layer(upscale_antialiasing,pre_filter=nn.Sequential(Aliased_Upscale_Layer(CEMnet.ds_factor,pre_stride,post_stride),antialiasing_Padder),
+                filtering_mode=filtering_mode)
+        if polyphase_scaling:
+            self.DownscaleOP = Strided_Downscale_Layer(downscale_antialiasing,ds_factor=CEMnet.ds_factor,pre_stride=pre_stride,pre_filter=antialiasing_Padder,filtering_mode=filtering_mode)
+        else:
+            self.DownscaleOP = Filter_Layer(downscale_antialiasing,pre_filter=antialiasing_Padder,post_filter=Aliased_Downscale_Layer(CEMnet.ds_factor,pre_stride),filtering_mode=filtering_mode)
         self.LR_padder = CEMnet.LR_padder
         self.HR_padder = CEMnet.HR_padder
         self.HR_unpadder = CEMnet.HR_unpadder
         self.LR_unpadder = CEMnet.LR_unpadder#Debugging tool
         self.pre_pad = False #Using a variable as flag because I couldn't pass it as argument to forward function when using the DataParallel module with more than 1 GPU
-        self.return_2_components = 'decomposed_output' in self.conf.__dict__ and self.conf.decomposed_output
+        self.return_2_components = bool('decomposed_output' in conf.__dict__ and conf.decomposed_output)
+        # Radius (in LR pixels) of the region affecting each output pixel through the projection, given the generator output:
+        scaling_margin = int(np.ceil(antialiasing_padding.max()/CEMnet.ds_factor))+1
+        self.projection_margin_LR = int(inv_hTh_padding.max())+2*scaling_margin
+        # Precision policy: The generator (and if reduced_precision_filters, also the CEM filters) is autocast to precision, while the CEM components are combined in the input's precision.
+        # The CEM filters are kept in fp32 by default, since they are cheap compared with the generator, and computing them in bf16 increases the consistency error by orders of magnitude:
+        self.precision = conf.precision if 'precision' in conf.__dict__ else 'fp32'
+        assert self.precision=='fp32' or self.precision in self.PRECISION_DTYPES,'Unsupported precision %s'%(self.precision)
+        self.reduced_precision_filters = bool('reduced_precision_filters' in conf.__dict__ and conf.reduced_precision_filters)
+        # Only the generator is computed in channels-last memory format, since it slows down the large depthwise CEM filters:
+        self.channels_last = bool('channels_last' in conf.__dict__ and conf.channels_last)
+        if self.channels_last:
+            self.generated_image_model.to(memory_format=torch.channels_last)
 
     def forward(self, x):
-        return_2_components = self.return_2_components and not self.pre_pad
         if self.pre_pad:
-            LR_Z = x.size(1) - 3 == self.generated_image_model.num_latent_channels
-            if x.size(1)!=3 and not LR_Z:
-                latent_input_HR,x = torch.split(x,split_size_or_sections=[x.size(1)-3,3],dim=1)
-                latent_input_HR = latent_input_HR.view([latent_input_HR.size(0)]+[-1]+[self.generated_image_model.upscale*val for val in list(latent_input_HR.size()[2:])])
-                x = self.LR_padder(x)
-                latent_input_HR = self.HR_padder(latent_input_HR).view([latent_input_HR.size(0)]+[latent_input_HR.size(1)*self.generated_image_model.upscale**2]+list(x.size()[2:]))
-                x = torch.cat([latent_input_HR,x],1)
-            else:
-                x = self.LR_padder(x)
-        generated_image = self.generated_image_model(x)
+            x,latent_input = self.Split_Input(x)
+            if latent_input is not None:
+                latent_input = self.Pad_Latent(latent_input,x)
+            return self.HR_unpadder(self.Enforce_Consistency(self.Merge_Input(self.LR_padder(x),latent_input)))
+        if not torch.jit.is_scripting(): # Decomposed output is not supported in TorchScript
+            if self.return_2_components:
+                return list(self.Decomposed_Output(x))
+        return self.Enforce_Consistency(x)
+
+    def Split_Input(self,x:torch.Tensor)->Tuple[torch.Tensor,Optional[torch.Tensor]]:
+        # Returns the LR image and the latent input (or None), with the latent input in its original spatial layout (either LR or HR):
+        if x.size(1)==3:
+            return x,None
+        LR_Z = x.size(1) - 3 == self.num_latent_channels
+        latent_input,x = torch.split(x,[x.size(1)-3,3],1)
+        if not LR_Z:
+            latent_input = latent_input.contiguous().view([latent_input.size(0),-1,self.latent_upscale*latent_input.size(2),self.latent_upscale*latent_input.size(3)])
+        return x,latent_input
+
+    def Merge_Input(self,x:torch.Tensor,latent_input:Optional[torch.Tensor]):
+        if latent_input is None:
+            return x
+        if latent_input.size(2)!=x.size(2):
+            latent_input = latent_input.contiguous().view([latent_input.size(0),latent_input.size(1)*self.latent_upscale*self.latent_upscale,x.size(2),x.size(3)])
+        return torch.cat([latent_input,x],1)
+
+    def Pad_Latent(self,latent_input:torch.Tensor,x:torch.Tensor):
+        return self.LR_padder(latent_input) if latent_input.size(2)==x.size(2) else self.HR_padder(latent_input)
+
+    def Decomposed_Output(self,x):
+        if not torch.jit.is_scripting(): # Autocasting is not supported in TorchScript, where everything is computed in the input's precision
+            if self.precision!='fp32':
+                return self.Reduced_Precision_Decomposed_Output(x)
+        return self.Project(x,self.Generate(x))
+
+    def Generate(self,x):
+        return self.generated_image_model(x.contiguous(memory_format=torch.channels_last) if self.channels_last else x).to(x.dtype).contiguous()
+
+    @torch.jit.unused
+    def Reduced_Precision_Decomposed_Output(self,x):
+        assert self.precision!='fp16' or x.is_cuda,'fp16 convolutions are impractically slow on CPU. Use bf16 instead'
+        dtype = self.PRECISION_DTYPES[self.precision]
+        with torch.autocast(device_type=x.device.type,dtype=dtype):
+            generated_image = self.Generate(x)
+            with torch.autocast(device_type=x.device.type,dtype=dtype,enabled=self.reduced_precision_filters):
+                return self.Project(x,generated_image)
+
+    def Project(self,x,generated_image):
         x = x[:,-3:,:,:]# Handling the case of adding noise channel(s) - Using only last 3 image channels
-        assert np.all(np.mod(generated_image.size()[2:],self.ds_factor)==0)
-        ortho_2_NS_HR_component = self.Upscale_OP(self.Conv_LR_with_Inv_hTh_OP(x))
-        ortho_2_NS_generated = self.Upscale_OP(self.Conv_LR_with_Inv_hTh_OP(self.DownscaleOP(generated_image)))
+        assert generated_image.size(2)%self.ds_factor==0 and generated_image.size(3)%self.ds_factor==0
+        ortho_2_NS_HR_component = self.Upscale_OP(self.Conv_LR_with_Inv_hTh_OP(x)).to(x.dtype)
+        ortho_2_NS_generated = self.Upscale_OP(self.Conv_LR_with_Inv_hTh_OP(self.DownscaleOP(generated_image))).to(x.dtype)
         NS_HR_component = generated_image - ortho_2_NS_generated
-        if self.conf.sigmoid_range_limit:
-            NS_HR_component = torch.tanh(NS_HR_component)*(self.conf.input_range[1]-self.conf.input_range[0])
-        output = [ortho_2_NS_HR_component,NS_HR_component] if return_2_components else ortho_2_NS_HR_component+NS_HR_component
-        return self.HR_unpadder(output) if self.pre_pad else output
+        if self.sigmoid_range_limit:
+            NS_HR_component = torch.tanh(NS_HR_component)*self.range_span
+        return ortho_2_NS_HR_component,NS_HR_component
+
+    def Enforce_Consistency(self,x):
+        ortho_2_NS_HR_component,NS_HR_component = self.Decomposed_Output(x)
+        return ortho_2_NS_HR_component+NS_HR_component
+
+    def Estimate_Memory_per_LR_Pixel(self,x):
+        # Running the generator on a small probe crop, and taking the largest layer output as a proxy for the peak memory consumption:
+        PROBE_SIZE = 16
+        PEAK_MEMORY_FACTOR = 4 # Accounting for the feature maps kept alive alongside the largest one (residual and densely concatenated features)
+        x,latent_input = self.Split_Input(x)
+        probe_size = [min(PROBE_SIZE,val) for val in x.size()[2:]]
+        if latent_input is not None:
+            latent_scale = latent_input.size(2)//x.size(2)
+            latent_input = latent_input[:1,:,:latent_scale*probe_size[0],:latent_scale*probe_size[1]]
+        layer_outputs_size = []
+        def Record_Output_Size(module,input,output):
+            if torch.is_tensor(output):
+                layer_outputs_size.append(output.numel()*output.element_size())
+        hooks = [m.register_forward_hook(Record_Output_Size) for m in self.generated_image_model.modules() if len(list(m.children()))==0]
+        with torch.no_grad():
+            self.generated_image_model(self.Merge_Input(x[:1,:,:probe_size[0],:probe_size[1]],latent_input))
+        for hook in hooks:
+            hook.remove()
+        return PEAK_MEMORY_FACTOR*max(layer_outputs_size)/np.prod(probe_size)
+
+    def Tiled_Forward(self,x,generator_margin_LR,memory_budget_MB):
+        # Inference in overlapping tiles, keeping peak memory roughly within memory_budget_MB. Each tile is cropped (with margins) from the padded input, and only its
+        # central part is kept. With generator_margin_LR bounding the generator's receptive field radius, the output equals that of the entire-image forward pass,
+        # up to floating point differences between convolution implementations.
+        assert self.pre_pad,'Tiled processing is only supported in inference (eval) mode'
+        x = x.detach()
+        if 'memory_per_LR_pixel' not in self.__dict__:
+            self.memory_per_LR_pixel = self.Estimate_Memory_per_LR_Pixel(x)
+        margin = generator_margin_LR+self.projection_margin_LR
+        tile_size = int(np.sqrt(memory_budget_MB*2**20/(x.size(0)*self.memory_per_LR_pixel)))-2*margin
+        assert tile_size>0,'Memory budget of %dMB cannot accomodate tiles with margins of %d LR pixels'%(memory_budget_MB,margin)
+        image_size = list(x.size()[2:])
+        padded_x,padded_latent,latent_scale = self.Pad_Input(x)
+        output = torch.zeros([x.size(0),3]+[self.ds_factor*val for val in image_size]).type(x.type()).to(x.device)
+        for row in range(0,image_size[0],tile_size):
+            for col in range(0,image_size[1],tile_size):
+                tile_start = [row,col]
+                tile_end = [min(row+tile_size,image_size[0]),min(col+tile_size,image_size[1])]
+                output[:,:,self.ds_factor*tile_start[0]:self.ds_factor*tile_end[0],self.ds_factor*tile_start[1]:self.ds_factor*tile_end[1]] =\
+                    self.Region_Forward(padded_x,padded_latent,latent_scale,tile_start,tile_end,margin)
+        return output
+
+    def Pad_Input(self,x):
+        # Splitting and padding the input as in the inference (pre_pad) forward pass. Returns the padded LR image, the padded latent input (or None) and the latent to LR size ratio:
+        x,latent_input = self.Split_Input(x)
+        if latent_input is None:
+            return self.LR_padder(x),None,1
+        return self.LR_padder(x),self.Pad_Latent(latent_input,x),latent_input.size(2)//x.size(2)
+
+    def Region_Forward(self,padded_x,padded_latent,latent_scale,region_start,region_end,margin):
+        # The inference output for the LR region [region_start,region_end), computed from a crop of the padded input (see Pad_Input) around it. With margin bounding the radius
+        # of the generator's and projection's receptive fields (in LR pixels), it equals the corresponding part of the entire-image output:
+        padding = int(self.LR_padder.padding[0])
+        crop_start = [max(0,region_start[axis]+padding-margin) for axis in range(2)]
+        crop_end = [min(padded_x.size(axis+2),region_end[axis]+padding+margin) for axis in range(2)]
+        region_input = padded_x[:,:,crop_start[0]:crop_end[0],crop_start[1]:crop_end[1]]
+        if padded_latent is not None:
+            region_input = self.Merge_Input(region_input,padded_latent[:,:,latent_scale*crop_start[0]:latent_scale*crop_end[0],latent_scale*crop_start[1]:latent_scale*crop_end[1]])
+        region_output = self.Enforce_Consistency(region_input)
+        offset = [self.ds_factor*(region_start[axis]+padding-crop_start[axis]) for axis in range(2)]
+        return region_output[:,:,offset[0]:offset[0]+self.ds_factor*(region_end[0]-region_start[0]),offset[1]:offset[1]+self.ds_factor*(region_end[1]-region_start[1])]
+
+    def Precision_Errors(self,x,precision=None):
+        # Errors introduced by computing in a reduced precision (defaults to the configured one) rather than in fp32. Consistency errors are between the downscaled output
+        # and the LR input, excluding the invalidity margins, and are reported for both precisions, as they are not exactly 0 in fp32 either:
+        precision = self.precision if precision is None else precision
+        configured_precision,outputs = self.precision,{}
+        try:
+            with torch.no_grad():
+                for cur_precision in ['fp32',precision]:
+                    self.precision = cur_precision
+                    output = self.forward(x)
+                    outputs[cur_precision] = (sum(output) if isinstance(output,list) else output).float()
+        finally:
+            self.precision = configured_precision
+        with torch.no_grad():
+            LR_image = self.LR_unpadder(self.Split_Input(x)[0].float())
+            errors = {}
+            for cur_precision in ['fp32',precision]:
+                consistency_error = self.LR_unpadder(self.DownscaleOP(outputs[cur_precision]))-LR_image
+                errors['consistency_RMSE_'+cur_precision] = consistency_error.pow(2).mean().sqrt().item()
+                errors['consistency_max_err_'+cur_precision] = consistency_error.abs().max().item()
+            output_diff = outputs[precision]-outputs['fp32']
+            errors['output_RMSE_diff'] = output_diff.pow(2).mean().sqrt().item()
+            errors['output_max_diff'] = output_diff.abs().max().item()
+        return errors
 
     def train(self,mode=True):
         super(CEM_PyTorch,self).train(mode=mode)
         self.pre_pad = not mode
+        return self
 
     def Image_2_Sigmoid_Range_Converter(self,images,opposite_direction=False):
         if opposite_direction:
-            return images*(self.conf.input_range[1]-self.conf.input_range[0])+self.conf.input_range[0]
+            return images*(self.input_range[1]-self.input_range[0])+self.input_range[0]
         else:
-            images = torch.clamp(images,min=self.conf.input_range[0],max=self.conf.input_range[1])
-            return (images-self.conf.input_range[0])/(self.conf.input_range[1] - self.conf.input_range[0])
+            images = torch.clamp(images,min=self.input_range[0],max=self.input_range[1])
+            return (images-self.input_range[0])/(self.input_range[1] - self.input_range[0])
     def Inverse_Sigmoid(self,images):
         return torch.log(self.Image_2_Sigmoid_Range_Converter(images)/(1.-self.Image_2_Sigmoid_Range_Converter(images)))
 
@@ -382,6 +710,12 @@ def Get_CEM_Conf(sf):
         filter_pertubation_limit = 0.999
         sigmoid_range_limit = False
         lower_magnitude_bound = 0.01 # Lower bound on hTh filter magnitude in Fourier domain
+        polyphase_scaling = True # Computing the CEM upscaling and downscaling operations at LR resolution rather than HR
+        filtering_mode = 'auto' # 'spatial', 'FFT' or 'auto' (choosing per filter and image size, based on a rough cost model)
+        precomputation_cache_dir = None # Optional directory for storing precomputed filters and margins on disk (e.g. '~/.cache/CEM'). None for only caching them in memory
+        precision = 'fp32' # 'fp32', 'bf16' or 'fp16' (GPU only) precision for computing the generator (see CEM_PyTorch)
+        reduced_precision_filters = False # Computing the CEM filters in the reduced precision too
+        channels_last = False # Computing the generator in channels-last memory format
     return conf
 
 def Adjust_State_Dict_Keys(loaded_state_dict,current_state_dict):
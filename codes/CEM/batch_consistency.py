@@ -0,0 +1,114 @@
+import os
+import csv
+from concurrent.futures import ProcessPoolExecutor,FIRST_COMPLETED,wait
+import numpy as np
+import cv2
+import CEM.CEMnet as CEMnet
+from CEM.imresize_CEM import imresize,Kernel_Hash
+
+IMG_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.tif', '.tiff']
+PENDING_PAIRS_PER_WORKER = 2 # Bounding the number of pairs submitted to the pool but not yet processed
+STATS_FIELDS = ['name','scale','LR_RMSE_before','LR_RMSE_after','LR_max_err_after','SR_change_RMSE','error']
+
+CEM_nets = {} # One CEMnet per (scale factor, kernel, lower magnitude bound), in each process
+loaded_kernels = {} # Kernels loaded from .npy files, per file path, in each process
+
+def Pairs_From_Folders(LR_folder,SR_folder):
+    # Pairing LR and SR images by their file names (excluding extensions):
+    LR_images = dict([(os.path.splitext(f)[0],os.path.join(LR_folder,f)) for f in sorted(os.listdir(LR_folder)) if os.path.splitext(f)[1].lower() in IMG_EXTENSIONS])
+    pairs = []
+    for f in sorted(os.listdir(SR_folder)):
+        if os.path.splitext(f)[1].lower() in IMG_EXTENSIONS and os.path.splitext(f)[0] in LR_images:
+            pairs.append((LR_images[os.path.splitext(f)[0]],os.path.join(SR_folder,f),None))
+    assert len(pairs)>0,'Found no LR and SR images with matching names in %s and %s'%(LR_folder,SR_folder)
+    return pairs
+
+def Pairs_From_Manifest(manifest_path):
+    # Each manifest line holds an LR image path, an SR image path and optionally a kernel (.npy file path or 'cubic'), separated by commas. Relative paths are relative to the manifest:
+    pairs = []
+    manifest_folder = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path,'r') as f:
+        for line in csv.reader(f):
+            line = [field.strip() for field in line]
+            if len(line)==0 or line[0]=='' or line[0].startswith('#'):
+                continue
+            assert len(line) in [2,3],'Invalid manifest line: %s'%(','.join(line))
+            kernel = line[2] if len(line)==3 and line[2]!='' else None
+            if kernel is not None and kernel.endswith('.npy'):
+                kernel = os.path.join(manifest_folder,kernel)
+            pairs.append((os.path.join(manifest_folder,line[0]),os.path.join(manifest_folder,line[1]),kernel))
+    return pairs
+
+def Load_Kernel(kernel):
+    if isinstance(kernel,str) and kernel.endswith('.npy'):
+        if kernel not in loaded_kernels:
+            loaded_kernels[kernel] = np.load(kernel)
+        kernel = loaded_kernels[kernel]
+    return kernel
+
+def Return_CEMnet(scale,kernel,lower_magnitude_bound=None):
+    # None and 'cubic' both stand for the default cubic kernel, so they share one CEMnet, built with an explicit 'cubic' kernel:
+    if kernel is None or (isinstance(kernel,str) and kernel in ['cubic','reset_2_default']):
+        kernel = 'cubic'
+    key = (scale,kernel if not isinstance(kernel,np.ndarray) else Kernel_Hash(kernel),lower_magnitude_bound)
+    if key not in CEM_nets:
+        CEM_conf = CEMnet.Get_CEM_Conf(scale)
+        if lower_magnitude_bound is not None:
+            CEM_conf.lower_magnitude_bound = lower_magnitude_bound
+        CEM_nets[key] = CEMnet.CEMnet(CEM_conf,upscale_kernel=kernel)
+    return CEM_nets[key]
+
+def RMSE(im1,im2):
+    return float(np.sqrt(np.mean((im1-im2)**2)))
+
+def Enforce_Consistency_on_Pair(LR_path,SR_path,kernel,output_folder,lower_magnitude_bound=None):
+    LR_im = cv2.imread(LR_path,cv2.IMREAD_COLOR).astype(np.float32)/255.
+    SR_im = cv2.imread(SR_path,cv2.IMREAD_COLOR).astype(np.float32)/255.
+    scale = SR_im.shape[0]//LR_im.shape[0]
+    assert scale>1 and all([SR_im.shape[i]==scale*LR_im.shape[i] for i in range(2)]),'SR image %s size is not an integer multiplication of its LR image size'%(SR_path)
+    kernel = Load_Kernel(kernel)
+    CEM_net = Return_CEMnet(scale,kernel,lower_magnitude_bound=lower_magnitude_bound)
+    consistent_im = CEM_net.Enforce_DT_on_Image_Pair(LR_im,SR_im)
+    name = os.path.splitext(os.path.basename(SR_path))[0]
+    cv2.imwrite(os.path.join(output_folder,name+'.png'),(255*np.clip(consistent_im,0,1)).round().astype(np.uint8))
+    downscaled_consistent = imresize(consistent_im,[1/scale],kernel=kernel)
+    return dict(zip(STATS_FIELDS,[name,scale,RMSE(imresize(SR_im,[1/scale],kernel=kernel),LR_im),RMSE(downscaled_consistent,LR_im),float(np.max(np.abs(downscaled_consistent-LR_im))),
+                                  RMSE(consistent_im,SR_im),None]))
+
+def Failed_Pair_Stats(SR_path,error):
+    return dict(zip(STATS_FIELDS,[os.path.splitext(os.path.basename(SR_path))[0]]+[None]*(len(STATS_FIELDS)-2)+['%s: %s'%(type(error).__name__,error)]))
+
+def Safely_Enforce_Consistency_on_Pair(LR_path,SR_path,kernel,output_folder,lower_magnitude_bound=None):
+    # A failing pair is reported in its statistics' error field, rather than aborting the entire batch:
+    try:
+        return Enforce_Consistency_on_Pair(LR_path,SR_path,kernel,output_folder,lower_magnitude_bound)
+    except Exception as e:
+        return Failed_Pair_Stats(SR_path,e)
+
+def Enforce_Consistency_Batch(pairs,output_folder,kernel=None,num_workers=0,lower_magnitude_bound=None):
+    # Yields the residual statistics dict of each processed pair (in order of completion when num_workers>0). Pairs are (LR path, SR path, kernel or None for the default kernel).
+    # Pairs that fail are yielded with their error field set (and all other statistics but the name set to None), and the remaining pairs are still processed:
+    os.makedirs(output_folder,exist_ok=True)
+    pairs = iter(pairs)
+    if num_workers==0:
+        for LR_path,SR_path,pair_kernel in pairs:
+            yield Safely_Enforce_Consistency_on_Pair(LR_path,SR_path,kernel if pair_kernel is None else pair_kernel,output_folder,lower_magnitude_bound)
+        return
+    def Result(future):
+        SR_path = pending_SR_paths.pop(future)
+        try:
+            return future.result()
+        except Exception as e: # Failures outside the pair processing itself (e.g. a worker process dying)
+            return Failed_Pair_Stats(SR_path,e)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        pending,pending_SR_paths = set(),{}
+        for LR_path,SR_path,pair_kernel in pairs:
+            if len(pending)>=PENDING_PAIRS_PER_WORKER*num_workers:
+                done,pending = wait(pending,return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield Result(future)
+            future = executor.submit(Safely_Enforce_Consistency_on_Pair,LR_path,SR_path,kernel if pair_kernel is None else pair_kernel,output_folder,lower_magnitude_bound)
+            pending.add(future)
+            pending_SR_paths[future] = SR_path
+        for future in wait(pending).done:
+            yield Result(future)
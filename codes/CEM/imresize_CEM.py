@@ -1,13 +1,24 @@
 import cv2
 import numpy as np
-from scipy.signal import convolve2d
+from scipy.signal import convolve2d,fftconvolve
+import scipy.fft
 from scipy.signal import gaussian
 from scipy.stats import norm
+import hashlib
+from utils.cache import LRU_Cache
 import torch # For using GPU when working with a very large anti-aliasing kernel, e.g. when using extreme upscaling/downscaling such as 32x
 
+KERNEL_CACHE_SIZE = 64
+RESAMPLING_MATRIX_CACHE_SIZE = 256
+LARGE_KERNEL_SIZE = 1000 # Kernels with more elements are applied using the GPU or FFT (unless separable)
+LARGE_KERNEL_DEVICE = None # Set to 'cpu' to avoid using the GPU for large kernels even when available
+RESIZE_CPU_THREADS = -1 # Number of threads for FFT based filtering on the CPU (-1 for using all cores)
+
+def Kernel_Hash(kernel):
+    return hashlib.sha1(np.ascontiguousarray(kernel).tobytes()+str((kernel.shape,kernel.dtype)).encode()).hexdigest()
+
 def imresize(im, scale_factor=None, output_shape=None, kernel=None,align_center=False, return_upscale_kernel=False,use_zero_padding=False,antialiasing=True, kernel_shift_flag=False):
     assert kernel is None or any([word in kernel for word in ['cubic','blurry_cubic','reset_2_default']]) or isinstance(kernel,np.ndarray)
-    imresize.kernels = getattr(imresize,'kernels',{})
     if scale_factor is None:
         scale_factor = [output_shape[0]/im.shape[0]]
     elif not isinstance(scale_factor,list):
@@ -20,32 +31,19 @@ def imresize(im, scale_factor=None, output_shape=None, kernel=None,align_center=
     # Padding the kernel to compenstae for imbalanced padding, in the case of an even scale factor. This increases kernel size by 1 for even scale factors or 0 for odd:
     kernel_post_padding = np.maximum(0, pre_stride - post_stride)
     kernel_pre_padding = np.maximum(0, post_stride - pre_stride)
+    # The kernel is determined by each call's kernel argument alone (None, 'cubic' and 'reset_2_default' all meaning the default cubic kernel), so concurrent calls never interfere:
+    upscale_kernel = Return_Upscale_Kernel(kernel,sf_4_kernel)
     if isinstance(kernel,np.ndarray):
-        if str(sf_4_kernel) in imresize.kernels.keys():
-            print('Overriding previous kernel with given kernel...')
-        # assert str(sf_4_kernel) not in imresize.kernels.keys() or np.all(np.equal(kernel,imresize.kernels[str(sf_4_kernel)])),'If using non-default kernel, make sure I always use it.'
-        assert np.abs(1-np.sum(kernel))<np.finfo(np.float32).eps,'Supplied non-default kernel does not sum to 1'
-        # I assume the supplied kernel is a downscaling kernel, while the kernel saved here should be an upscaling one:
-        kernel = np.rot90(kernel,2)
-        kernel = Center_Mass(kernel,ds_factor=sf_4_kernel)*sf_4_kernel**2
-        assert kernel.shape[0]==kernel.shape[1],'Only square kernels supported for now'
-        assert np.all(np.mod(kernel.shape+kernel_post_padding+kernel_pre_padding-1,sf_4_kernel)==0),'Convolution-invalidated size should be an integer multiplication of sf_4_kernel'
-        imresize.kernels[str(sf_4_kernel)] = kernel
-    elif str(sf_4_kernel) not in imresize.kernels.keys() or kernel=='reset_2_default':
-        if str(sf_4_kernel) in imresize.kernels.keys(): #Called by 'reset_2_default'
-            print('Overriding previous kernel with default kernel...')
-        kernel_2_use = Cubic_Kernel(sf_4_kernel)
-        if kernel is not None and 'blurry_cubic' in kernel:
-            sigma = float(kernel[len('blurry_cubic_'):])
-            blur_kernel = Gaussian_2D(sigma=sigma)
-            imresize.kernels['blur_'+str(sf_4_kernel)] = blur_kernel
-            kernel_2_use = convolve2d(kernel_2_use,blur_kernel)
-        imresize.kernels[str(sf_4_kernel)] = kernel_2_use
-    antialiasing_kernel = np.pad(imresize.kernels[str(sf_4_kernel)],((kernel_pre_padding[0],kernel_post_padding[0]),(kernel_pre_padding[1],kernel_post_padding[1])),mode='constant')
-    if scale_factor < 1:
-        antialiasing_kernel = np.rot90(antialiasing_kernel * scale_factor ** 2, 2)
+        assert np.all(np.mod(upscale_kernel.shape+kernel_post_padding+kernel_pre_padding-1,sf_4_kernel)==0),'Convolution-invalidated size should be an integer multiplication of sf_4_kernel'
+    def Compute_Antialiasing_Kernel():
+        antialiasing_kernel = np.pad(upscale_kernel,((kernel_pre_padding[0],kernel_post_padding[0]),(kernel_pre_padding[1],kernel_post_padding[1])),mode='constant')
+        if scale_factor < 1:
+            antialiasing_kernel = np.rot90(antialiasing_kernel * scale_factor ** 2, 2)
+        return antialiasing_kernel,Separable_Filters(antialiasing_kernel)
+    antialiasing_key = (Kernel_Hash(upscale_kernel),sf_4_kernel,scale_factor<1,tuple(kernel_pre_padding),tuple(kernel_post_padding))
+    antialiasing_kernel,separable_filters = imresize.antialiasing_kernels.get(antialiasing_key,Compute_Antialiasing_Kernel)
     if return_upscale_kernel:
-        return antialiasing_kernel
+        return 1*antialiasing_kernel
     assert output_shape is None or np.all(scale_factor*np.array(im.shape[:2])==output_shape[:2])
     padding_size = np.floor(np.array(antialiasing_kernel.shape)/2).astype(np.int32)
     desired_size = scale_factor*np.array(im.shape[:2])
@@ -53,38 +51,108 @@ def imresize(im, scale_factor=None, output_shape=None, kernel=None,align_center=
     desired_size = desired_size.astype(np.int32)
     if im.ndim<3:
         im = np.expand_dims(im,-1)
-    output = []
+    if separable_filters is not None:
+        # Filtering each axis separately, all channels at once. Only the samples retained after downscaling are computed, and when upscaling only non-zero samples of the
+        # zero-stuffed image are multiplied (polyphase filtering):
+        output_dtype = np.result_type(im.dtype,antialiasing_kernel.dtype)
+        output = 0
+        for filter_num,filters in enumerate(separable_filters):
+            filtered = im
+            for axis in range(2):
+                filtered = np.moveaxis(filtered,axis,0)
+                resampling_matrix = imresize.resampling_matrices.get(antialiasing_key+(filter_num,axis,im.shape[axis],float(scale_factor),int(pre_stride[axis]),use_zero_padding,np.dtype(output_dtype).str),
+                    lambda:Resampling_Matrix(im.shape[axis],filters[axis],scale_factor,pre_stride[axis],use_zero_padding,dtype=output_dtype))
+                filtered = resampling_matrix.dot(filtered.reshape([im.shape[axis],-1])).reshape([-1]+list(filtered.shape[1:]))
+                filtered = np.moveaxis(filtered,0,axis)
+            output = output+filtered
+        return np.squeeze(output)
 
     def filter2d(input,special_padding_size=None):
+        # Filtering all channels of the HxWxC input:
         if special_padding_size is not None:
-            input = 1*np.pad(input, pad_width=((special_padding_size[0], special_padding_size[0]), (special_padding_size[1], special_padding_size[1])),mode='edge')
-        if antialiasing_kernel.size > 1000:
-            print('Using GPU for image resizing (since kernel is of size %dx%d)' % (antialiasing_kernel.shape[0], antialiasing_kernel.shape[1]))
-            return torch.nn.functional.conv2d(torch.from_numpy(input).cuda().unsqueeze(0).unsqueeze(0),
-                torch.from_numpy(1 * np.rot90(antialiasing_kernel.astype(input.dtype), 2)).unsqueeze(0).unsqueeze(0).cuda(),
-                padding=(antialiasing_kernel.shape[0] // 2,antialiasing_kernel.shape[1] // 2) if special_padding_size is None else 0).squeeze(0).squeeze(0).cpu().numpy()
-        else:
-            return convolve2d(input,antialiasing_kernel,'same' if special_padding_size is None else 'valid')
-
-    for channel_num in range(im.shape[2]):
-        if scale_factor>1:#Upscale
-            output.append(np.reshape(np.pad(np.expand_dims(np.expand_dims(im[:,:,channel_num],2),1),((0,0),(pre_stride[0],post_stride[0]),(0,0),(pre_stride[1],post_stride[1])),
-                mode='constant'),newshape=desired_size))
-            if use_zero_padding:
-                output[-1] = filter2d(output[-1])
-                # output[-1] = conv2(output[-1],antialiasing_kernel,mode='same')
-            else:# Use edge padding:
-                # output[-1] = conv2(np.pad(output[-1],pad_width=((padding_size[0],padding_size[0]),(padding_size[1],padding_size[1])),mode='edge'),antialiasing_kernel,mode='valid')
-                output[-1] = filter2d(output[-1],special_padding_size=padding_size)
+            input = 1*np.pad(input, pad_width=((special_padding_size[0], special_padding_size[0]), (special_padding_size[1], special_padding_size[1]),(0,0)),mode='edge')
+        mode = 'same' if special_padding_size is None else 'valid'
+        if antialiasing_kernel.size > LARGE_KERNEL_SIZE:
+            return Large_Kernel_Filter(input,antialiasing_kernel,mode)
         else:
-            if use_zero_padding:
-                output.append(filter2d(im[:,:,channel_num]))
-            else:# Use edge padding:
-                # output.append(conv2(np.pad(im[:,:,channel_num],pad_width=((padding_size[0],padding_size[0]),(padding_size[1],padding_size[1])),mode='edge'),
-                #                     antialiasing_kernel,mode='valid'))
-                output.append(filter2d(im[:, :, channel_num],special_padding_size=padding_size))
-            output[-1] = output[-1][pre_stride[0]::int(1 / scale_factor),pre_stride[1]::int(1 / scale_factor)]
-    return np.squeeze(np.stack(output,-1))
+            return np.stack([convolve2d(input[:,:,channel_num],antialiasing_kernel,mode) for channel_num in range(input.shape[2])],-1)
+
+    if scale_factor>1:#Upscale
+        output = np.reshape(np.pad(np.expand_dims(np.expand_dims(im,2),1),((0,0),(pre_stride[0],post_stride[0]),(0,0),(pre_stride[1],post_stride[1]),(0,0)),
+            mode='constant'),list(desired_size)+[im.shape[2]])
+        if use_zero_padding:
+            output = filter2d(output)
+        else:# Use edge padding:
+            output = filter2d(output,special_padding_size=padding_size)
+    else:
+        if use_zero_padding:
+            output = filter2d(im)
+        else:# Use edge padding:
+            output = filter2d(im,special_padding_size=padding_size)
+        output = output[pre_stride[0]::int(1 / scale_factor),pre_stride[1]::int(1 / scale_factor)]
+    return np.squeeze(output)
+
+def Large_Kernel_Filter(input,kernel,mode):
+    # Filtering all channels of the HxWxC input at once, on the GPU if available (and not disabled by LARGE_KERNEL_DEVICE). Otherwise using FFT based convolution,
+    # whose cost (unlike direct convolution) does not grow with the kernel size, on RESIZE_CPU_THREADS threads. Like the direct convolution, filtering is done (and returned) in float64:
+    input,kernel = input.astype(np.float64),kernel.astype(np.float64)
+    if LARGE_KERNEL_DEVICE!='cpu' and torch.cuda.is_available():
+        print('Using GPU for image resizing (since kernel is of size %dx%d)' % (kernel.shape[0], kernel.shape[1]))
+        return torch.nn.functional.conv2d(torch.from_numpy(np.ascontiguousarray(input.transpose((2,0,1)))).cuda().unsqueeze(1),
+            torch.from_numpy(1 * np.rot90(kernel, 2)).unsqueeze(0).unsqueeze(0).cuda(),
+            padding=(kernel.shape[0] // 2,kernel.shape[1] // 2) if mode=='same' else 0).squeeze(1).cpu().numpy().transpose((1,2,0))
+    with scipy.fft.set_workers(RESIZE_CPU_THREADS):
+        return fftconvolve(input,np.expand_dims(kernel,-1),mode=mode,axes=(0,1))
+
+imresize.upscale_kernels = LRU_Cache(KERNEL_CACHE_SIZE) # Upscaling kernels, keyed by the given kernel's content (or the default kernel's name) and the scale factor
+imresize.antialiasing_kernels = LRU_Cache(KERNEL_CACHE_SIZE) # Padded and rotated kernels (and their separable decomposition), keyed by kernel content, scale factor and padding
+imresize.resampling_matrices = LRU_Cache(RESAMPLING_MATRIX_CACHE_SIZE) # Per-axis sparse resampling matrices, keyed by the antialiasing kernel key, filter, axis, size, scale factor and padding
+
+def Return_Upscale_Kernel(kernel,sf):
+    # Returns the upscaling kernel corresponding to a given downscaling kernel (array), or otherwise to the default cubic kernel (blurred, for 'blurry_cubic_<sigma>'):
+    if isinstance(kernel,np.ndarray):
+        assert np.abs(1-np.sum(kernel))<np.finfo(np.float32).eps,'Supplied non-default kernel does not sum to 1'
+        def Process_Given_Kernel():
+            # I assume the supplied kernel is a downscaling kernel, while the kernel saved here should be an upscaling one:
+            processed_kernel = Center_Mass(np.rot90(kernel,2),ds_factor=sf)*sf**2
+            assert processed_kernel.shape[0]==processed_kernel.shape[1],'Only square kernels supported for now'
+            return processed_kernel
+        return imresize.upscale_kernels.get((Kernel_Hash(kernel),sf),Process_Given_Kernel)
+    kernel_name = kernel if kernel is not None and 'blurry_cubic' in kernel else 'cubic'
+    def Default_Kernel():
+        default_kernel = Cubic_Kernel(sf)
+        if kernel_name!='cubic':
+            default_kernel = convolve2d(default_kernel,Gaussian_2D(sigma=float(kernel_name[len('blurry_cubic_'):])))
+        return default_kernel
+    return imresize.upscale_kernels.get((kernel_name,sf),Default_Kernel)
+
+def Separable_Filters(kernel):
+    # Decomposing the kernel into a sum of outer products of 1D filters, using its SVD. Returns None when the kernel's numerical rank makes it not worth it:
+    u,singular_values,vh = np.linalg.svd(kernel)
+    rank = np.sum(singular_values>singular_values[0]*np.max(kernel.shape)*np.finfo(np.float64).eps)
+    if 2*rank>=np.min(kernel.shape):
+        return None
+    return [(u[:,i]*np.sqrt(singular_values[i]),vh[i,:]*np.sqrt(singular_values[i])) for i in range(rank)]
+
+def Resampling_Matrix(input_size,filter,scale_factor,pre_stride,use_zero_padding,dtype=np.float64):
+    # Sparse matrix applying to a 1D signal the operations done by imresize along one axis: zero-stuffing (when upscaling), convolution with the filter (using zero or
+    # edge padding) and sub-sampling (when downscaling). Only non-zero products are included, so both up and downscaling cost is proportional to the number of output samples.
+    from scipy.sparse import csr_matrix
+    stuffing_factor = int(scale_factor) if scale_factor>1 else 1
+    stuffed_size = stuffing_factor*input_size
+    source_index = -1*np.ones([stuffed_size],dtype=np.int64) # Input sample corresponding to each sample of the zero-stuffed signal (-1 for stuffed zeros)
+    source_index[pre_stride if scale_factor>1 else 0::stuffing_factor] = np.arange(input_size)
+    padding_size = len(filter)//2
+    filtered_size = stuffed_size if use_zero_padding else stuffed_size+2*padding_size-len(filter)+1
+    output_index = np.arange(filtered_size) if scale_factor>1 else np.arange(pre_stride,filtered_size,int(np.round(1/scale_factor)))
+    stuffed_index = output_index.reshape([-1,1])-padding_size+np.arange(len(filter)).reshape([1,-1])
+    if use_zero_padding:
+        valid = np.logical_and(stuffed_index>=0,stuffed_index<stuffed_size)
+    else:
+        stuffed_index,valid = np.clip(stuffed_index,0,stuffed_size-1),True
+    taps = np.where(valid,source_index[np.clip(stuffed_index,0,stuffed_size-1)],-1)
+    rows,tap_nums = np.nonzero(taps>=0)
+    return csr_matrix((filter[::-1][tap_nums].astype(dtype),(rows,taps[rows,tap_nums])),shape=[len(output_index),input_size])
 
 def calc_strides(array,factor,align_center = False):
     integer_factor = np.maximum(factor,1/factor).astype(np.int32)
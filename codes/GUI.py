@@ -9,7 +9,7 @@ import argparse
 from models import create_model
 import options.options as option
 import utils.util as util
-from Z_optimization import Z_optimizer,ReturnPatchExtractionMat
+from Z_optimization import Z_optimizer,Return_Patch_Extractor,Z_Store,Z_Optimization_Profiler
 from utils.logger import Logger
 import data.util as data_util
 import numpy as np
@@ -20,6 +20,8 @@ import imageio
 from skimage.transform import resize
 from scipy.signal import find_peaks
 import time
+import queue
+import threading
 from collections import deque
 
 # Explorable SR imports:
@@ -59,6 +61,10 @@ TRACK_ADDED_SCRIBLES = True # When True, using the recent modification that allo
 Z_OPTIMIZATION_TIME_LIMIT = 30  # seconds
 NON_LOCAL_Z_OPTIMIZATION = True #When True, optimizing over the entire region passed to the optimizer (depends on MARGINS_AROUND_REGION_OF_INTEREST), while penalizing for changes in the masked regions.
 AUTO_MASK_GRAPHICAL_INPUT = True and NON_LOCAL_Z_OPTIMIZATION#When NON_LOCAL_Z_OPTIMIZATION is on, would automatically surround scribble mask by dilation to automatically create mask.
+Z_WARM_START_STORE = None # Folder for persistently storing optimized Zs, used for warm-starting Z optimization with the same image, model, objective and mask (across sessions). None for not storing
+Z_WARM_START_STORE_SIZE_MB = 256
+Z_OPTIMIZATION_PROFILING = False # When True, logging per-iteration Z optimization timings (per phase), generator forwards per second and peak GPU memory
+Z_OPTIMIZATION_PREVIEW_INTERVAL = 0.25 # Minimal time (seconds) between displayed previews of the output during Z optimization
 
 # For the "desired dictionary of patches" tool, allowing multi-scale dictionary:
 DOWNSCALED_HIST_VERSIONS = False#0.9
@@ -100,6 +106,64 @@ CANVAS_DIMENSIONS = 600, 400
 SELECTION_PEN = QPen(QColor(0xff, 0x00, 0x00), 3, Qt.DashLine)
 PREVIEW_PEN = QPen(QColor(0xff, 0xff, 0xff), 1, Qt.SolidLine)
 
+class Z_Optimization_Worker(QThread):
+    # Runs Z optimization rounds in a background thread, so that the GUI remains responsive. Rounds are queued as (job id, Z optimizer) pairs, and their results (the optimized Z,
+    # or the raised exception) are returned through the round_finished signal. Intermediate outputs are sent through the preview_ready signal, at most every Z_OPTIMIZATION_PREVIEW_INTERVAL.
+    # The model is used by the worker while a round is running (idle is not set). The GUI does not use it until the round finishes, as MainWindow.Model_Actions_Enabling disables the model-using actions throughout the job.
+    round_finished = pyqtSignal(int,object)
+    preview_ready = pyqtSignal(int,object)
+
+    def __init__(self):
+        super(Z_Optimization_Worker, self).__init__()
+        self.jobs = queue.Queue()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.latest_job_id = None
+        self.cancelled_jobs,self.discarded_jobs = set(),set()
+        self.start()
+
+    def run(self):
+        while True:
+            job_id,Z_optimizer = self.jobs.get()
+            if Z_optimizer is None:
+                break
+            self.latest_preview_time = 0
+            Z_optimizer.iteration_callback = lambda optimizer:self.Iteration_Callback(job_id,optimizer)
+            try:
+                result = Z_optimizer.optimize()
+            except Exception as e:
+                result = e
+            Z_optimizer.iteration_callback = None
+            self.idle.set() # Releasing the model before the GUI handles the result
+            self.round_finished.emit(job_id,result)
+
+    def Submit(self,job_id,Z_optimizer):
+        self.idle.clear()
+        self.latest_job_id = job_id
+        self.jobs.put((job_id,Z_optimizer))
+
+    def Iteration_Callback(self,job_id,Z_optimizer):
+        # Returns True for stopping the optimization round:
+        if job_id in self.cancelled_jobs:
+            return True
+        if time.time()-self.latest_preview_time>=Z_OPTIMIZATION_PREVIEW_INTERVAL and 'random' not in Z_optimizer.objective:# Random objectives display alternative Zs, rather than the current one
+            self.latest_preview_time = time.time()
+            self.preview_ready.emit(job_id,255*Z_optimizer.model.Output_Batch(within_0_1=True)[0].detach().float().cpu().numpy().transpose(1,2,0))
+        return False
+
+    def Cancel(self,discard=False):
+        # Stopping the latest job after its current iteration, without waiting for it. When discarding, its result is ignored once its round finishes:
+        if self.latest_job_id is None:
+            return
+        self.cancelled_jobs.add(self.latest_job_id)
+        if discard:
+            self.discarded_jobs.add(self.latest_job_id)
+
+    def Stop(self):
+        self.Cancel(discard=True)
+        self.jobs.put((None,None))
+        self.wait()
+
 class Canvas(QLabel):
 
     mode = 'rectangle'
@@ -120,6 +184,8 @@ class Canvas(QLabel):
     timer_event = None
     existing_selection_timer_event = None
     selection_display = None
+    Z_optimization_worker = None
+    model_actions_enabled = True # Mouse input is ignored while a Z optimization job is using the model
 
     def initialize(self):
         self.background_color = QColor(self.secondary_color) if self.secondary_color else QColor(Qt.white)
@@ -317,6 +383,8 @@ class Canvas(QLabel):
     # Mouse events.
 
     def mousePressEvent(self, e):
+        if not self.model_actions_enabled:
+            return
         if (self.mode in self.scribble_modes) and not self.within_drawing and not self.in_picking_desired_hist_mode:
             # self.scribble_mode_entry_operations(imprinting='imprint' in self.mode)
             self.scribble_mode_entry_operations(drawing='imprint' not in self.mode and self.color_state==0)
@@ -338,6 +406,8 @@ class Canvas(QLabel):
             self.scribble_mask_canvas.setPixmap(QPixmap(qimage2ndarray.array2qimage(np.zeros_like(self.saved_scribble_mask_canvas))))
 
     def mouseMoveEvent(self, e):
+        if not self.model_actions_enabled:
+            return
         fn = getattr(self, "%s_mouseMoveEvent" % self.mode, None)
         if fn:
             return fn(e)
@@ -346,6 +416,8 @@ class Canvas(QLabel):
         return np.any(self.HR_mask_display_size*qimage2ndarray.rgb_view(self.scribble_mask_canvas.pixmap().toImage())[:, :, 0])
 
     def mouseReleaseEvent(self, e):
+        if not self.model_actions_enabled:
+            return
         fn = getattr(self, "%s_mouseReleaseEvent" % self.mode, None)
         if fn:
             returnable =  fn(e)
@@ -397,6 +469,8 @@ class Canvas(QLabel):
 
 
     def mouseDoubleClickEvent(self, e):
+        if not self.model_actions_enabled:
+            return
         fn = getattr(self, "%s_mouseDoubleClickEvent" % self.mode, None)
         if fn:
             returnable =  fn(e)
@@ -603,6 +677,8 @@ class Canvas(QLabel):
             self.safe_scribble_apply_buttons_enabling()
 
     def Z_optimizer_Reset(self):
+        if self.Z_optimization_worker is not None:
+            self.Z_optimization_worker.Cancel(discard=True)
         self.Z_optimizer_initial_LR = Z_OPTIMIZER_INITIAL_LR
         self.Z_optimizer = None
         self.Z_optimizer_logger = None
@@ -890,8 +966,9 @@ class Canvas(QLabel):
                 util.ResizeCategorialImage(desired_HR_im_mask.astype(np.uint8),dsize=tuple([v*(self.opt['scale'] if LR_phase else 1) for v in org_size])
                                            ,inclusive=True)
             if LR_phase:
-                resized_desired_im = imresize(resized_desired_im,1/self.opt['scale'])
-                resized_desired_im_mask = imresize(resized_desired_im_mask,1/self.opt['scale'])!=0
+                imresize_kernel = self.SR_model.CEM_net.imresize_kernel if getattr(self.SR_model,'CEM_net',None) is not None else None
+                resized_desired_im = imresize(resized_desired_im,1/self.opt['scale'],kernel=imresize_kernel)
+                resized_desired_im_mask = imresize(resized_desired_im_mask,1/self.opt['scale'],kernel=imresize_kernel)!=0
             return np.sum(np.abs(resized_desired_im-existing_im)*np.expand_dims(resized_desired_im_mask,-1))/np.sum(resized_desired_im_mask)/3
 
         desired_image = self.Project_2_Orthog_Nullspace(self.desired_graphic_input)[desired_mask_bounding_rect[1]:desired_mask_bounding_rect[1] + desired_mask_bounding_rect[3],
@@ -1313,10 +1390,15 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         util.Assign_GPU()
         self.num_random_Zs = NUM_RANDOM_ZS
+        self.Z_store = Z_Store(Z_WARM_START_STORE,max_size_MB=Z_WARM_START_STORE_SIZE_MB) if Z_WARM_START_STORE is not None else None
         self.opt = option.parse(parser.parse_args().opt, is_train=False,name=opt_name)
         self.opt = option.dict_to_nonedict(self.opt)
         self.display_ESRGAN = not self.JPEG_GUI and DISPLAY_ESRGAN_RESULTS and 'pretrained_ESRGAN' in self.opt['path'].keys()
         self.canvas = Canvas()
+        self.canvas.Z_optimization_worker = Z_Optimization_Worker()
+        self.canvas.Z_optimization_worker.round_finished.connect(self.Z_Optimization_Round_Finished)
+        self.canvas.Z_optimization_worker.preview_ready.connect(self.Display_Z_Optimization_Preview)
+        self.Z_optimization_job,self.pending_Z_optimization,self.Z_optimization_jobs_counter = None,None,0
         self.setupUi()
         # Replace canvas placeholder from QtDesigner.
         self.horizontalLayout.removeWidget(self.canvas)
@@ -1618,6 +1700,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
     def Feed_n_Run_model(self,cur_Z):
         DEBUG_CHROMA = False
+        assert self.canvas.Z_optimization_worker.idle.is_set(),'The model cannot be used while being optimized over'
         self.canvas.SR_model.Prepare_Input(self.var_L, latent_input=torch.zeros_like(cur_Z) if DEBUG_CHROMA else cur_Z,compressed_input=True)
         if DEBUG_CHROMA:
             print('Y Z STD:%.4f'%(self.canvas.SR_model.GetLatent().std()))
@@ -1777,6 +1860,18 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.canvas.Update_Z_Sliders()
             self.ReProcess()
 
+    def Model_Actions_Enabling(self,enable):
+        # Disabling everything that uses the model or cur_Z while a Z optimization job runs, leaving enabled only the Z optimization tools, that replace (or stop) the running job.
+        # Toolbars are disabled as a whole, so that the enabling state of their buttons is kept for when the job finishes:
+        for toolbar in self.model_actions_TBs:
+            toolbar.setEnabled(enable)
+        self.ProcessRandZ_button.setEnabled(enable) # Producing a single random image does not go through Optimize_Z
+        self.canvas.model_actions_enabled = enable
+
+    def closeEvent(self,event):
+        self.canvas.Z_optimization_worker.Stop()
+        super(MainWindow, self).closeEvent(event)
+
     def Validate_Z_optimizer(self,objective):
         if self.latest_optimizer_objective!=objective:# or objective=='hist': # Resetting optimizer in the 'patchhist' case because I use automatic tempersture search there, so I want to search each time for the best temperature.
             self.canvas.Z_optimizer_Reset()
@@ -1858,6 +1953,10 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             Set_Inner_Attr(key, self.Crop2BoundingRect(cur_attr, bounding_rect=bounding_rect, SF=size_factor[0]))
 
     def Optimize_Z(self,objective,loop=False):
+        if self.Z_optimization_job is not None:# Replacing the running optimization, which stops after its current iteration
+            self.pending_Z_optimization = (objective,loop)
+            self.canvas.Z_optimization_worker.Cancel()
+            return
         if self.special_behavior_button.isChecked():
             objective = objective.replace('STD','local_Mag').replace('periodicity','periodicityPlus')
         if LOCAL_STD_4_OPT:
@@ -1961,7 +2060,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 Z_range=self.max_SVD_Lambda,data=data,initial_LR=self.canvas.Z_optimizer_initial_LR,loggers=self.canvas.Z_optimizer_logger,max_iters=self.iters_per_round,
                 image_mask=self.canvas.HR_selected_mask,Z_mask=self.canvas.Z_mask,auto_set_hist_temperature=self.auto_set_hist_temperature,
                 batch_size=optimization_batch_size,random_Z_inits=self.random_inits,initial_Z=initial_Z,
-                jpeg_extractor=self.canvas.SR_model.jpeg_extractor if self.JPEG_GUI else None,non_local_Z_optimization=NON_LOCAL_Z_OPTIMIZATION)
+                jpeg_extractor=self.canvas.SR_model.jpeg_extractor if self.JPEG_GUI else None,non_local_Z_optimization=NON_LOCAL_Z_OPTIMIZATION,Z_store=self.Z_store,
+                profiler=Z_Optimization_Profiler(Logger(self.canvas.opt,tb_logger_suffix='_%s_profile'%(objective))) if Z_OPTIMIZATION_PROFILING else None)
             if self.optimizing_region:
                 self.MasksStorage(False)
             if AUTO_MASK_GRAPHICAL_INPUT and 'scribble' in objective:
@@ -1970,99 +2070,157 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         elif 'random' in objective:
             self.canvas.Z_optimizer.cur_iter = 0
-        num_looping_iters = 30 if loop else 1
-        reset_Z_optimizer,decrease_LR = False,False
-        optimization_start_time = time.time()
-        for mini_epoch in range(num_looping_iters):
-            self.stored_Z = 1 * self.cur_Z
-            if self.multiple_inits:
-                self.stored_masked_zs = 1*self.canvas.random_Zs
-                if 'random' not in objective:
-                    self.stored_masked_zs = torch.cat([1*self.cur_Z,self.stored_masked_zs],0)
-            else:
-                self.stored_masked_zs = 1 * self.cur_Z # Storing previous Z for two reasons: To recover the big picture Z when optimizing_region, and to recover previous Z if loss did not decrease
-            try:
-                self.statusBar.showMessage('Optimizing for %s...'%(objective))
-                optimization_failed =True
-                self.cur_Z = self.canvas.Z_optimizer.optimize()
-                optimization_failed = False
-            except Exception as e:
-                self.statusBar.showMessage('%s optimization failed: %s' % (objective,e), ERR_MESSAGE_DURATION)
-                print('Optimization failed: ',e)
-                if 'loss' in self.canvas.Z_optimizer.__dict__.keys() and 'bins' in self.canvas.Z_optimizer.loss.__dict__.keys():
-                    print('# desired hist images: %d'%(len(self.canvas.desired_image)))
-                    print('# Bins: %d, # Image patches: %d'%(self.canvas.Z_optimizer.loss.bins.size(-1),self.canvas.Z_optimizer.loss.patch_extraction_mat.size(1)))
-            discard_result = optimization_failed or self.canvas.Z_optimizer.loss_values[0] - self.canvas.Z_optimizer.loss_values[-1] < 0
-            time_limit_reached = time.time()-optimization_start_time>Z_OPTIMIZATION_TIME_LIMIT
-            if discard_result:
-                self.cur_Z = 1 * self.stored_Z
-                self.canvas.SR_model.Prepare_Input(self.var_L,latent_input=self.cur_Z.type(self.var_L.type()),compressed_input=True)
-                self.SelectImage2Display()
-                reset_Z_optimizer = True
-                decrease_LR = not optimization_failed
-                if loop:
-                    break
-            else:
-                if self.optimizing_region:
-                    temp_Z = (1 * self.cur_Z).to(self.stored_masked_zs.device)
-                    self.cur_Z = 1 * self.stored_masked_zs
-                    cropping_rect = 1*self.bounding_rect_4_opt
-                    if self.canvas.HR_Z:
-                        cropping_rect = [self.canvas.H_L_domains_ratio*val for val in self.bounding_rect_4_opt]
-                    for Z_num in range(temp_Z.size(0)): # Doing this for the case of finding random Zs far from one another:
-                        if ONLY_MODIFY_MASKED_AREA_WHEN_OPTIMIZING:
-                            self.cur_Z[Z_num, :, cropping_rect[1]:cropping_rect[1] + cropping_rect[3],cropping_rect[0]:cropping_rect[0] + cropping_rect[2]] =\
-                                self.Z_mask_4_later_merging*temp_Z[Z_num, ...]+\
-                                (1-self.Z_mask_4_later_merging)*self.cur_Z[Z_num, :, cropping_rect[1]:cropping_rect[1] + cropping_rect[3],cropping_rect[0]:cropping_rect[0] + cropping_rect[2]]
-                        else:
-                            self.cur_Z[Z_num, :, cropping_rect[1]:cropping_rect[1] + cropping_rect[3],cropping_rect[0]:cropping_rect[0] + cropping_rect[2]] = temp_Z[Z_num,...]
-                avoid_Z_undo_list_update = mini_epoch<(num_looping_iters-1) and not time_limit_reached
-                if self.multiple_inits:
-                    self.canvas.random_Zs = 1*self.cur_Z[-self.num_random_Zs:]
-                    self.Process_Z_Alternatives()
-                    if 'random' in objective:
-                        self.cur_Z = 1*self.stored_Z
+        self.Z_optimization_jobs_counter += 1
+        self.Z_optimization_job = {'id':self.Z_optimization_jobs_counter,'objective':objective,'loop':loop,'num_looping_iters':30 if loop else 1,'mini_epoch':0,
+            'start_time':time.time(),'reset_Z_optimizer':False,'decrease_LR':False,'optimization_failed':True,'cancelled':False}
+        self.Model_Actions_Enabling(False)
+        self.Start_Z_Optimization_Round()
+
+    def Start_Z_Optimization_Round(self):
+        # Optimization rounds run in the background by the Z optimization worker, while the GUI keeps responding (and displaying previews). Each round's result is handled by Z_Optimization_Round_Finished:
+        self.stored_Z = 1 * self.cur_Z
+        if self.multiple_inits:
+            self.stored_masked_zs = 1*self.canvas.random_Zs
+            if 'random' not in self.Z_optimization_job['objective']:
+                self.stored_masked_zs = torch.cat([1*self.cur_Z,self.stored_masked_zs],0)
+        else:
+            self.stored_masked_zs = 1 * self.cur_Z # Storing previous Z for two reasons: To recover the big picture Z when optimizing_region, and to recover previous Z if loss did not decrease
+        self.statusBar.showMessage('Optimizing for %s...'%(self.Z_optimization_job['objective']))
+        self.canvas.Z_optimization_worker.Submit(self.Z_optimization_job['id'],self.canvas.Z_optimizer)
+
+    def Z_Optimization_Round_Finished(self,job_id,result):
+        job = self.Z_optimization_job
+        if job is None or job_id!=job['id']:
+            return
+        if job_id in self.canvas.Z_optimization_worker.discarded_jobs:# The model was needed by the GUI while optimizing, so the round's result was discarded
+            self.canvas.Z_optimizer = None
+            self.statusBar.showMessage('%s optimization was stopped.' % (job['objective']), INFO_MESSAGE_DURATION)
+            self.Finish_Z_Optimization(completed=False)
+            return
+        job['cancelled'] = job_id in self.canvas.Z_optimization_worker.cancelled_jobs
+        if self.Process_Z_Optimization_Round(result) or job['cancelled'] or job['mini_epoch']==job['num_looping_iters']-1:
+            self.Finish_Z_Optimization()
+        else:
+            job['mini_epoch'] += 1
+            self.Start_Z_Optimization_Round()
+
+    def Process_Z_Optimization_Round(self,result):
+        # Handling the round's result (the optimized Z, or the raised exception). Returns True for breaking the optimization loop:
+        job = self.Z_optimization_job
+        objective,loop,mini_epoch = job['objective'],job['loop'],job['mini_epoch']
+        optimization_failed = isinstance(result,Exception)
+        job['optimization_failed'] = optimization_failed
+        if optimization_failed:
+            self.statusBar.showMessage('%s optimization failed: %s' % (objective,result), ERR_MESSAGE_DURATION)
+            print('Optimization failed: ',result)
+            if 'loss' in self.canvas.Z_optimizer.__dict__.keys() and 'bins' in self.canvas.Z_optimizer.loss.__dict__.keys():
+                print('# desired hist images: %d'%(len(self.canvas.desired_image)))
+                print('# Bins: %d, # Image patches: %d'%(self.canvas.Z_optimizer.loss.bins.size(-1),self.canvas.Z_optimizer.loss.patch_extraction_mat.num_patches))
+        else:
+            self.cur_Z = result
+        discard_result = optimization_failed or self.canvas.Z_optimizer.loss_values[0] - self.canvas.Z_optimizer.loss_values[-1] < 0
+        time_limit_reached = time.time()-job['start_time']>Z_OPTIMIZATION_TIME_LIMIT
+        if discard_result:
+            self.cur_Z = 1 * self.stored_Z
+            self.canvas.SR_model.Prepare_Input(self.var_L,latent_input=self.cur_Z.type(self.var_L.type()),compressed_input=True)
+            self.SelectImage2Display()
+            job['reset_Z_optimizer'] = True
+            job['decrease_LR'] = not optimization_failed
+            if loop:
+                return True
+        else:
+            if self.optimizing_region:
+                temp_Z = (1 * self.cur_Z).to(self.stored_masked_zs.device)
+                self.cur_Z = 1 * self.stored_masked_zs
+                cropping_rect = 1*self.bounding_rect_4_opt
+                if self.canvas.HR_Z:
+                    cropping_rect = [self.canvas.H_L_domains_ratio*val for val in self.bounding_rect_4_opt]
+                for Z_num in range(temp_Z.size(0)): # Doing this for the case of finding random Zs far from one another:
+                    if ONLY_MODIFY_MASKED_AREA_WHEN_OPTIMIZING:
+                        self.cur_Z[Z_num, :, cropping_rect[1]:cropping_rect[1] + cropping_rect[3],cropping_rect[0]:cropping_rect[0] + cropping_rect[2]] =\
+                            self.Z_mask_4_later_merging*temp_Z[Z_num, ...]+\
+                            (1-self.Z_mask_4_later_merging)*self.cur_Z[Z_num, :, cropping_rect[1]:cropping_rect[1] + cropping_rect[3],cropping_rect[0]:cropping_rect[0] + cropping_rect[2]]
                     else:
-                        self.cur_Z = 1 * self.cur_Z[0].unsqueeze(0)
-                        display_index = ([self.cur_Z_im_index]+self.random_display_indexes)[np.argmin(self.canvas.Z_optimizer.latest_Z_loss_values)]
-                        print('Loss values (%d):'%(np.argmin(self.canvas.Z_optimizer.latest_Z_loss_values)),['%.3e'%(val) for val in self.canvas.Z_optimizer.latest_Z_loss_values])
-                        self.ReProcess(chosen_display_index=display_index,dont_update_undo_list=avoid_Z_undo_list_update)
+                        self.cur_Z[Z_num, :, cropping_rect[1]:cropping_rect[1] + cropping_rect[3],cropping_rect[0]:cropping_rect[0] + cropping_rect[2]] = temp_Z[Z_num,...]
+            avoid_Z_undo_list_update = mini_epoch<(job['num_looping_iters']-1) and not time_limit_reached and not job['cancelled']
+            if self.multiple_inits:
+                self.canvas.random_Zs = 1*self.cur_Z[-self.num_random_Zs:]
+                self.Process_Z_Alternatives()
+                if 'random' in objective:
+                    self.cur_Z = 1*self.stored_Z
                 else:
-                    self.DeriveControlValues()
-                    self.ReProcess(chosen_display_index=self.cur_Z_im_index if 'scribble' in objective else None,dont_update_undo_list=avoid_Z_undo_list_update)
-            if loop and time_limit_reached:
-                print('Z optimization time limit (%d sec.) reached.'%(Z_OPTIMIZATION_TIME_LIMIT))
-                break
+                    self.cur_Z = 1 * self.cur_Z[0].unsqueeze(0)
+                    display_index = ([self.cur_Z_im_index]+self.random_display_indexes)[np.argmin(self.canvas.Z_optimizer.latest_Z_loss_values)]
+                    print('Loss values (%d):'%(np.argmin(self.canvas.Z_optimizer.latest_Z_loss_values)),['%.3e'%(val) for val in self.canvas.Z_optimizer.latest_Z_loss_values])
+                    self.ReProcess(chosen_display_index=display_index,dont_update_undo_list=avoid_Z_undo_list_update)
+            else:
+                self.DeriveControlValues()
+                self.ReProcess(chosen_display_index=self.cur_Z_im_index if 'scribble' in objective else None,dont_update_undo_list=avoid_Z_undo_list_update)
+        if loop and time_limit_reached:
+            print('Z optimization time limit (%d sec.) reached.'%(Z_OPTIMIZATION_TIME_LIMIT))
+            return True
 
-            if not optimization_failed:
-                print('%d: LR=%.1e, %d iterations: %s loss decreased from %.2e to %.2e by %.2e (factor of %.2e)' % (mini_epoch,self.canvas.Z_optimizer.LR,len(self.canvas.Z_optimizer.loss_values), self.canvas.Z_optimizer.objective,
-                    self.canvas.Z_optimizer.loss_values[0],self.canvas.Z_optimizer.loss_values[-1],self.canvas.Z_optimizer.loss_values[0] - self.canvas.Z_optimizer.loss_values[-1],
-                    self.canvas.Z_optimizer.loss_values[-1]/self.canvas.Z_optimizer.loss_values[0]))
-                if (self.canvas.Z_optimizer.loss_values[-int(np.abs(self.iters_per_round))]-self.canvas.Z_optimizer.loss_values[-1])/\
-                        np.abs(self.canvas.Z_optimizer.loss_values[-int(np.abs(self.iters_per_round))])<1e-2*self.canvas.Z_optimizer_initial_LR: #If the loss did not decrease, I decrease the optimizer's learning rate
-                    decrease_LR = True
-                    # self.canvas.Z_optimizer_initial_LR /= 5
-                    # print('Loss decreased too little relative to beginning, decreasing learning rate to %.3e'%(self.canvas.Z_optimizer_initial_LR))
-                    # reset_Z_optimizer = True
-                    if loop:
-                        print('Breaking optimization loop')
-                        if mini_epoch<(num_looping_iters-1):
-                            self.Add_Z_2_history()
-                        break
-                else: # This means I'm happy with this optimizer (and its learning rate), so I can cancel the auto-hist-temperature setting, in case it was set to True.
-                    if self.auto_hist_temperature_mode_Enabled:
-                        self.auto_set_hist_temperature = False
-                        self.auto_hist_temperature_mode_button.setChecked(False)
-        if reset_Z_optimizer:
-            self.canvas.Z_optimizer = None
-            # Optimization already caused backpropagation through the current fake_H without recomputing it. So it needs to be recomputed to allow another backpropagation:
-            self.Feed_n_Run_model(self.cur_Z)
-        if decrease_LR:
-            self.canvas.Z_optimizer_initial_LR /= 5
-            print('Loss decreased too little relative to beginning, decreasing learning rate to %.3e' % (
-                self.canvas.Z_optimizer_initial_LR))
         if not optimization_failed:
-            self.statusBar.showMessage('%s optimization is done.' % (objective), INFO_MESSAGE_DURATION)
+            print('%d: LR=%.1e, %d iterations: %s loss decreased from %.2e to %.2e by %.2e (factor of %.2e)' % (mini_epoch,self.canvas.Z_optimizer.LR,len(self.canvas.Z_optimizer.loss_values), self.canvas.Z_optimizer.objective,
+                self.canvas.Z_optimizer.loss_values[0],self.canvas.Z_optimizer.loss_values[-1],self.canvas.Z_optimizer.loss_values[0] - self.canvas.Z_optimizer.loss_values[-1],
+                self.canvas.Z_optimizer.loss_values[-1]/self.canvas.Z_optimizer.loss_values[0]))
+            if (self.canvas.Z_optimizer.loss_values[-int(np.abs(self.iters_per_round))]-self.canvas.Z_optimizer.loss_values[-1])/\
+                    np.abs(self.canvas.Z_optimizer.loss_values[-int(np.abs(self.iters_per_round))])<1e-2*self.canvas.Z_optimizer_initial_LR: #If the loss did not decrease, I decrease the optimizer's learning rate
+                job['decrease_LR'] = True
+                # self.canvas.Z_optimizer_initial_LR /= 5
+                # print('Loss decreased too little relative to beginning, decreasing learning rate to %.3e'%(self.canvas.Z_optimizer_initial_LR))
+                # reset_Z_optimizer = True
+                if loop:
+                    print('Breaking optimization loop')
+                    if mini_epoch<(job['num_looping_iters']-1):
+                        self.Add_Z_2_history()
+                    return True
+            else: # This means I'm happy with this optimizer (and its learning rate), so I can cancel the auto-hist-temperature setting, in case it was set to True.
+                if self.auto_hist_temperature_mode_Enabled:
+                    self.auto_set_hist_temperature = False
+                    self.auto_hist_temperature_mode_button.setChecked(False)
+        return False
+
+    def Finish_Z_Optimization(self,completed=True):
+        job = self.Z_optimization_job
+        self.Z_optimization_job = None
+        self.Model_Actions_Enabling(True)
+        if completed:
+            if job['reset_Z_optimizer']:
+                self.canvas.Z_optimizer = None
+                # Optimization already caused backpropagation through the current fake_H without recomputing it. So it needs to be recomputed to allow another backpropagation:
+                self.Feed_n_Run_model(self.cur_Z)
+            if job['decrease_LR']:
+                self.canvas.Z_optimizer_initial_LR /= 5
+                print('Loss decreased too little relative to beginning, decreasing learning rate to %.3e' % (
+                    self.canvas.Z_optimizer_initial_LR))
+            if not job['optimization_failed']:
+                self.statusBar.showMessage('%s optimization is done.' % (job['objective']), INFO_MESSAGE_DURATION)
+        if self.pending_Z_optimization is not None:# Starting the optimization that replaced this one
+            objective,loop = self.pending_Z_optimization
+            self.pending_Z_optimization = None
+            self.Optimize_Z(objective,loop=loop)
+
+    def Display_Z_Optimization_Preview(self,job_id,preview):
+        # Displaying the intermediate output of the running optimization round, pasted into the displayed image when optimizing an image region:
+        if self.Z_optimization_job is None or job_id!=self.Z_optimization_job['id'] or job_id in self.canvas.Z_optimization_worker.cancelled_jobs:
+            return
+        if self.Zdisplay_button.isChecked() or self.canvas.current_display_index==self.canvas.scribble_display_index:
+            return
+        self.canvas.selection_display_timer_cleanup()
+        im_2_display = qimage2ndarray.rgb_view(self.canvas.pixmap().toImage()).astype(np.float32)
+        if self.canvas.display_zoom_factor>1:
+            preview = imresize(preview,self.canvas.display_zoom_factor)
+        offset = [0,0]
+        if self.optimizing_region:
+            offset = [self.canvas.display_zoom_factor*self.canvas.HR_size[0]//self.canvas.LR_size[0]*val for val in self.bounding_rect_4_opt[1::-1]]
+        preview = np.clip(preview,0,255)[:im_2_display.shape[0]-offset[0],:im_2_display.shape[1]-offset[1]]
+        im_2_display[offset[0]:offset[0]+preview.shape[0],offset[1]:offset[1]+preview.shape[1]] = preview
+        pixmap = QPixmap()
+        pixmap.convertFromImage(qimage2ndarray.array2qimage(im_2_display))
+        self.canvas.setPixmap(pixmap)
+        if self.canvas.selection_display:
+            self.canvas.selection_display_timer_creation()
 
     def DeriveControlValues(self):
         normalized_Z = self.Z_2_three_channels(1*self.cur_Z.squeeze(0))
@@ -2317,8 +2475,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
     def Estimate_DerivedControlIndicator(self):
         PATCH_SIZE_4_ESTIMATION = 3
-        patch_extraction_map = ReturnPatchExtractionMat(self.canvas.Z_mask,PATCH_SIZE_4_ESTIMATION,device=self.cur_Z.device,patches_overlap=1)
-        STD_map = torch.sparse.mm(patch_extraction_map, self.cur_Z.mean(dim=1).view([-1, 1])).view([PATCH_SIZE_4_ESTIMATION ** 2, -1]).std(dim=0).view(
+        patch_extraction_map = Return_Patch_Extractor(self.canvas.Z_mask,PATCH_SIZE_4_ESTIMATION,device=self.cur_Z.device,patches_overlap=1)
+        STD_map = patch_extraction_map(self.cur_Z.mean(dim=1)).view([PATCH_SIZE_4_ESTIMATION ** 2, -1]).std(dim=0).view(
             [val-PATCH_SIZE_4_ESTIMATION+1 for val in list(self.cur_Z.size()[2:])])
         return np.pad((STD_map>0).data.cpu().numpy().astype(np.bool),pad_width=int(PATCH_SIZE_4_ESTIMATION//2),mode='edge')
 
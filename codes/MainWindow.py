@@ -339,6 +339,10 @@ class Ui_MainWindow(object):
             [getattr(self,button+'_imprinting_button') for button in (imprint_stretches+imprint_translations+imprint_rotations)],layout_cols=4)
 
 
+        # Toolbars disabled while a Z optimization job is using the model (leaving the Z optimization tools enabled):
+        self.model_actions_TBs = [load_and_save,display_TB,uniform_Z_control_TB,region_selection_TB,general_TB,scribble_A_TB,imprinting_TB,scribble_B_TB,modify_scrible_TB]+\
+            ([HSV_TB] if self.JPEG_GUI else [])
+
         #### Assemble layouts together to form GUI:
         self.verticalLayout_L = self.Define_Nesting_Layout(self.horizontalLayout, horizontal=False,name='verticalLayout_L')
         self.verticalLayout_C = self.Define_Nesting_Layout(self.horizontalLayout, horizontal=False,name='verticalLayout_C')
@@ -5,9 +5,12 @@ from skimage.color import rgb2hsv,hsv2rgb
 from scipy.signal import convolve2d
 import time
 from scipy.ndimage.morphology import binary_opening
-from sklearn.feature_extraction.image import extract_patches_2d
 from utils.util import IndexingHelper, Return_Translated_SubImage, Return_Interpolated_SubImage
 from cv2 import dilate
+import hashlib
+import os
+from glob import glob
+from utils.cache import LRU_Cache
 
 class Optimizable_Temperature(torch.nn.Module):
     def __init__(self,initial_temperature=None):
@@ -19,15 +22,204 @@ class Optimizable_Temperature(torch.nn.Module):
     def forward(self):
         return torch.exp(self.log_temperature)
 
+class Chunked_Soft_Histogram(torch.autograd.Function):
+    # Soft histogram (KDE) of image (num_dims x pixels) over bins (num_dims x bins), computed in chunks of pixels and bins so that no num_dims x pixels x bins tensor is ever held
+    # beyond chunk_elements elements. Reduces over bins when per_pixel (returning each pixel's negative log mean kernel value, with bins weighted by their multiplicities if given),
+    # or otherwise over pixels (returning each bin's log mean kernel value). Both reductions are log-sum-exps, so that kernel values far below the smallest representable number
+    # (e.g. in single precision, for small temperatures) do not underflow. The backward pass recomputes each chunk instead of storing it.
+    @staticmethod
+    def forward(ctx,image,bins,bin_multiplicities,temperature,max_val,exp_power,epsilon,per_pixel,chunk_elements):
+        ctx.params = (temperature,max_val,exp_power,epsilon,per_pixel,chunk_elements)
+        if bin_multiplicities is None:
+            bin_multiplicities = torch.ones([bins.size(1)]).type(image.dtype).to(image.device)
+        log_bin_weights = torch.log(bin_multiplicities.type(image.dtype)/bin_multiplicities.sum()) # Only used when reducing over bins
+        log_sum_exp = torch.zeros([image.size(1) if per_pixel else bins.size(1)]).type(image.dtype).to(image.device)
+        for pixels,bins_ranges in Chunked_Soft_Histogram.Chunks(image,bins,chunk_elements):
+            chunk_log_sum_exp = []
+            for bins_range in bins_ranges:
+                log_kernel = Chunked_Soft_Histogram.Log_Kernel(image[:,pixels].unsqueeze(2)-bins[:,bins_range].unsqueeze(1),ctx.params)[0]
+                if per_pixel:
+                    chunk_log_sum_exp.append(torch.logsumexp(log_kernel+log_bin_weights[bins_range].unsqueeze(0),1))
+                elif pixels.start==0:
+                    log_sum_exp[bins_range] = torch.logsumexp(log_kernel,0)
+                else: # Accumulating over pixel chunks
+                    log_sum_exp[bins_range] = torch.logsumexp(torch.stack([log_sum_exp[bins_range],torch.logsumexp(log_kernel,0)],0),0)
+            if per_pixel:
+                log_sum_exp[pixels] = torch.logsumexp(torch.stack(chunk_log_sum_exp,0),0)
+        ctx.save_for_backward(image,bins,log_bin_weights,log_sum_exp)
+        if per_pixel:
+            return -log_sum_exp
+        return log_sum_exp-np.log(image.size(1))
+
+    @staticmethod
+    def backward(ctx,grad_output):
+        image,bins,log_bin_weights,log_sum_exp = ctx.saved_tensors
+        per_pixel,chunk_elements = ctx.params[-2:]
+        if not ctx.needs_input_grad[0]:
+            return (None,)*9
+        grad_image = torch.zeros_like(image)
+        for pixels,bins_ranges in Chunked_Soft_Histogram.Chunks(image,bins,chunk_elements):
+            for bins_range in bins_ranges:
+                log_kernel,log_kernel_derivative = Chunked_Soft_Histogram.Log_Kernel(image[:,pixels].unsqueeze(2)-bins[:,bins_range].unsqueeze(1),ctx.params,return_derivative=True)
+                if per_pixel:
+                    weights = -grad_output[pixels].unsqueeze(1)*torch.exp(log_kernel+log_bin_weights[bins_range].unsqueeze(0)-log_sum_exp[pixels].unsqueeze(1))
+                else:
+                    weights = grad_output[bins_range].unsqueeze(0)*torch.exp(log_kernel-log_sum_exp[bins_range].unsqueeze(0))
+                grad_image[:,pixels] += (log_kernel_derivative*weights.unsqueeze(0)).sum(2)
+        return (grad_image,)+(None,)*8
+
+    @staticmethod
+    def Chunks(image,bins,chunk_elements):
+        bins_chunk = max(1,min(bins.size(1),chunk_elements//image.size(0)))
+        pixels_chunk = max(1,chunk_elements//(image.size(0)*bins_chunk))
+        bins_ranges = [slice(b,b+bins_chunk) for b in range(0,bins.size(1),bins_chunk)]
+        return [(slice(p,p+pixels_chunk),bins_ranges) for p in range(0,image.size(1),pixels_chunk)]
+
+    @staticmethod
+    def Log_Kernel(difference,params,return_derivative=False):
+        # Returns the (pixels x bins) log kernel values of the (num_dims x pixels x bins) image-bins differences, averaged over dimensions, and optionally their derivatives
+        # w.r.t. each image dimension:
+        temperature,max_val,exp_power,epsilon = params[:4]
+        # Cyclic distance, taking the closest of the difference and its shifted versions:
+        difference = torch.where((difference-max_val).abs()<difference.abs(),difference-max_val,torch.where((difference+max_val).abs()<difference.abs(),difference+max_val,difference))
+        distance = difference.abs()+epsilon
+        log_kernel = -(distance**exp_power).mean(0)/temperature
+        if not return_derivative:
+            return log_kernel,None
+        return log_kernel,-exp_power*(distance**(exp_power-1))*torch.sign(difference)/temperature/difference.size(0)
+
+class Top_K_Soft_Histogram(torch.autograd.Function):
+    # Per pixel negative log KDE of image (num_dims x pixels) over the bins (num_dims x bins) given by candidates (pixels x k), with log_weights (pixels x k) being the candidates'
+    # log weights (-inf for invalid candidates). Computed in chunks of pixels, so that no num_dims x pixels x k tensor is ever held beyond chunk_elements elements. Like in
+    # Chunked_Soft_Histogram, the backward pass recomputes each chunk instead of storing it.
+    @staticmethod
+    def forward(ctx,image,bins,candidates,log_weights,temperature,max_val,exp_power,epsilon,chunk_elements):
+        ctx.params = (temperature,max_val,exp_power,epsilon,chunk_elements)
+        log_sum_exp = torch.zeros([image.size(1)]).type(image.dtype).to(image.device)
+        for pixels in Top_K_Soft_Histogram.Chunks(image,candidates,chunk_elements):
+            log_kernel = Chunked_Soft_Histogram.Log_Kernel(image[:,pixels].unsqueeze(2)-bins[:,candidates[pixels]],ctx.params)[0]
+            log_sum_exp[pixels] = torch.logsumexp(log_kernel+log_weights[pixels],1)
+        ctx.save_for_backward(image,bins,candidates,log_weights,log_sum_exp)
+        return -log_sum_exp
+
+    @staticmethod
+    def backward(ctx,grad_output):
+        image,bins,candidates,log_weights,log_sum_exp = ctx.saved_tensors
+        if not ctx.needs_input_grad[0]:
+            return (None,)*9
+        grad_image = torch.zeros_like(image)
+        for pixels in Top_K_Soft_Histogram.Chunks(image,candidates,ctx.params[-1]):
+            log_kernel,log_kernel_derivative = Chunked_Soft_Histogram.Log_Kernel(image[:,pixels].unsqueeze(2)-bins[:,candidates[pixels]],ctx.params,return_derivative=True)
+            weights = -grad_output[pixels].unsqueeze(1)*torch.exp(log_kernel+log_weights[pixels]-log_sum_exp[pixels].unsqueeze(1))
+            grad_image[:,pixels] = (log_kernel_derivative*weights.unsqueeze(0)).sum(2)
+        return (grad_image,)+(None,)*8
+
+    @staticmethod
+    def Chunks(image,candidates,chunk_elements):
+        pixels_chunk = max(1,chunk_elements//(image.size(0)*candidates.size(1)))
+        return [slice(p,p+pixels_chunk) for p in range(0,image.size(1),pixels_chunk)]
+
+class Nearest_Neighbor_Distance(torch.autograd.Function):
+    # Elementwise distance of each of the data (batch x ...) from its nearest neighbor among candidates (candidates_batch x ...), where candidate i and data i are the same sample, which is
+    # therefore not its own neighbor (its distance is replaced by 1). Candidates are compared in chunks of rows, so that no candidates_batch x batch x ... tensor is ever held beyond
+    # chunk_elements elements. Only the nearest neighbors' indexes are kept for the backward pass, whose gradient is that of taking the minimum over all (distances+eye) at once.
+    @staticmethod
+    def forward(ctx,candidates,data,chunk_elements):
+        flat_candidates,flat_data = candidates.reshape([candidates.size(0),-1]),data.reshape([data.size(0),-1])
+        nearest_distance = torch.empty_like(flat_data)
+        nearest_index = torch.empty(flat_data.size(),dtype=torch.long,device=data.device)
+        candidates_chunk = max(1,chunk_elements//flat_data.numel())
+        for first in range(0,candidates.size(0),candidates_chunk):
+            distance = (flat_candidates[first:first+candidates_chunk].unsqueeze(1)-flat_data.unsqueeze(0)).abs()
+            self_rows = torch.arange(first,max(first,min(first+candidates_chunk,candidates.size(0),data.size(0))),device=data.device)
+            distance[self_rows-first,self_rows] += 1
+            chunk_distance,chunk_index = torch.min(distance,dim=0)
+            if first==0:
+                nearest_distance,nearest_index = chunk_distance,chunk_index
+            else:
+                closer = chunk_distance<nearest_distance
+                nearest_distance = torch.where(closer,chunk_distance,nearest_distance)
+                nearest_index = torch.where(closer,chunk_index+first,nearest_index)
+        ctx.save_for_backward(candidates,data,nearest_index)
+        return nearest_distance.view(data.size())
+
+    @staticmethod
+    def backward(ctx,grad_output):
+        candidates,data,nearest_index = ctx.saved_tensors
+        flat_candidates = candidates.reshape([candidates.size(0),-1])
+        grad = grad_output.reshape(nearest_index.size())*torch.sign(data.reshape(nearest_index.size())-torch.gather(flat_candidates,0,nearest_index))
+        grad_candidates = None
+        if ctx.needs_input_grad[0]:
+            grad_candidates = torch.zeros_like(flat_candidates).scatter_add_(0,nearest_index,-grad).view(candidates.size())
+        return grad_candidates,grad.view(data.size()),None
+
+class Dictionary_Index:
+    # Approximate nearest neighbours search among dictionary bins (num_dims x bins), using a k-means codebook: Each query is only compared with the bins belonging to its
+    # num_probes closest clusters. Distances are Euclidean (ignoring the cyclic shifts of the soft histogram kernel).
+    KMEANS_ITERS = 10
+    KMEANS_SEED = 0 # Seeding the initial centroids choice, so that the approximated loss is reproducible
+    def __init__(self,bins,num_clusters=None,num_probes=4,chunk_elements=2**22):
+        self.bins = bins
+        self.num_probes = num_probes
+        self.chunk_elements = chunk_elements
+        num_clusters = int(np.ceil(np.sqrt(bins.size(1)))) if num_clusters is None else min(num_clusters,bins.size(1))
+        self.centroids = bins[:,torch.randperm(bins.size(1),generator=torch.Generator().manual_seed(self.KMEANS_SEED))[:num_clusters].to(bins.device)].clone()
+        for iter in range(self.KMEANS_ITERS):
+            assignments = self.Nearest(bins,self.centroids,1).view([-1])
+            counts = torch.bincount(assignments,minlength=num_clusters)
+            non_empty = counts>0
+            self.centroids[:,non_empty] = torch.zeros_like(self.centroids).index_add_(1,assignments,bins)[:,non_empty]/counts[non_empty].type(bins.dtype)
+        # Discarding empty clusters, and arranging the bins indexes in a (clusters x maximal cluster size) table, padded with -1:
+        assignments = self.Nearest(bins,self.centroids,1).view([-1])
+        counts = torch.bincount(assignments,minlength=num_clusters)
+        self.centroids = self.centroids[:,counts>0]
+        assignments = (torch.cumsum(counts>0,0)-1)[assignments]
+        counts = counts[counts>0]
+        order = torch.argsort(assignments)
+        position_in_cluster = torch.arange(bins.size(1)).to(bins.device)-(torch.cumsum(counts,0)-counts)[assignments[order]]
+        self.cluster_members = -1*torch.ones([counts.size(0),counts.max().item()]).long().to(bins.device)
+        self.cluster_members[assignments[order],position_in_cluster] = order
+
+    def Nearest(self,queries,references,k):
+        # Indexes (queries x k) of the k nearest references to each query:
+        nearest = []
+        chunk_size = max(1,self.chunk_elements//references.size(1))
+        for start in range(0,queries.size(1),chunk_size):
+            cur_queries = queries[:,start:start+chunk_size]
+            squared_distances = (references**2).sum(0).unsqueeze(0)-2*cur_queries.t().mm(references)
+            nearest.append(torch.topk(squared_distances,k,dim=1,largest=False)[1])
+        return torch.cat(nearest,0)
+
+    def Top_K(self,queries,k):
+        # Returns the (queries x k) indexes of the (approximately) k nearest bins to each query, and whether each index is valid (as the probed clusters may hold less than k bins):
+        indexes,valid = [],[]
+        num_probes = min(self.num_probes,self.centroids.size(1))
+        chunk_size = max(1,self.chunk_elements//(num_probes*self.cluster_members.size(1)*queries.size(0)))
+        with torch.no_grad():
+            for start in range(0,queries.size(1),chunk_size):
+                cur_queries = queries[:,start:start+chunk_size]
+                candidates = self.cluster_members[self.Nearest(cur_queries,self.centroids,num_probes)].view([cur_queries.size(1),-1])
+                squared_distances = ((cur_queries.unsqueeze(2)-self.bins[:,candidates.clamp(min=0)])**2).sum(0)
+                squared_distances[candidates<0] = float('inf')
+                top_distances,top_indexes = torch.topk(squared_distances,min(k,candidates.size(1)),dim=1,largest=False)
+                indexes.append(torch.gather(candidates,1,top_indexes).clamp(min=0))
+                valid.append(torch.isfinite(top_distances))
+        return torch.cat(indexes,0),torch.cat(valid,0)
+
 class SoftHistogramLoss(torch.nn.Module):
+    CHUNK_ELEMENTS = 2**22 # Maximal size of the intermediate (num_dims x pixels x bins) tensors when computing soft histograms
+    ANN_MIN_BINS = 4096 # Smaller dictionaries are always evaluated exactly
+    CALIBRATION_ELEMENTS = 2**24 # Maximal size of the (pixels x bins) kernel distances held by TemperatureSearch, determining its pixels subsample size
+    PRECISION = torch.float32 # Default dtype of the soft histogram/KDE computations. These are carried out in the log domain, so single precision (or bfloat16, on CPU) does not underflow
     def __init__(self,bins,min,max,desired_hist_image_mask=None,desired_hist_image=None,gray_scale=True,input_im_HR_mask=None,patch_size=1,automatic_temperature=False,
-            image_Z=None,temperature=0.05,dictionary_not_histogram=False,no_patch_DC=False,no_patch_STD=False):
+            image_Z=None,temperature=0.05,dictionary_not_histogram=False,no_patch_DC=False,no_patch_STD=False,dictionary_top_k=None,precision=None):
         self.temperature = temperature#0.05**2#0.006**6
         self.exp_power = 2#6
         self.SQRT_EPSILON = 1e-7
         super(SoftHistogramLoss,self).__init__()
         # min correspond to the CENTER of the first bin, and max to the CENTER of the last bin
         self.device = torch.device('cuda')
+        self.dtype = self.PRECISION if precision is None else precision
         self.bin_width = (max-min)/(bins-1)
         self.max = max
         self.no_patch_DC = no_patch_DC
@@ -44,18 +236,19 @@ class SoftHistogramLoss(torch.nn.Module):
         self.patch_size = patch_size
         self.num_dims = 3
         self.KDE = not gray_scale or patch_size>1 # Using Kernel Density Estimation rather than histogram
+        self.bin_multiplicities = None
         if gray_scale:
             self.num_dims = self.num_dims//3
-            self.bins = 1. * self.bin_centers.view([1] + list(self.bin_centers.size())).type(torch.cuda.DoubleTensor)
+            self.bins = 1. * self.bin_centers.view([1] + list(self.bin_centers.size())).to(self.device,self.dtype)
             if desired_hist_image is not None:
                 desired_hist_image = [hist_im.mean(1, keepdim=True).view([-1,1]) for hist_im in desired_hist_image]
         if patch_size>1:
             assert gray_scale and (desired_hist_image is not None),'Not supporting color images or patch histograms for model training loss for now'
             self.num_dims = patch_size**2
             DESIRED_HIST_PATCHES_OVERLAP = (self.num_dims-patch_size)/self.num_dims # Patches overlap should correspond to entire patch but one row/column.
-            desired_im_patch_extraction_mat = [ReturnPatchExtractionMat(hist_im_mask,patch_size=patch_size,device=self.device,
+            desired_im_patch_extractors = [Return_Patch_Extractor(hist_im_mask,patch_size=patch_size,device=self.device,
                 patches_overlap=DESIRED_HIST_PATCHES_OVERLAP) for hist_im_mask in desired_hist_image_mask]
-            desired_hist_image = [torch.sparse.mm(desired_im_patch_extraction_mat[i],desired_hist_image[i]).view([self.num_dims,-1,1]) for i in range(len(desired_hist_image))]
+            desired_hist_image = [desired_im_patch_extractors[i](desired_hist_image[i]).view([self.num_dims,-1,1]) for i in range(len(desired_hist_image))]
             # desired_hist_image = [self.Desired_Im_2_Bins(hist_im,prune_only=True) for hist_im in desired_hist_image]
             desired_hist_image = torch.cat(desired_hist_image,1)
             if self.no_patch_DC:
@@ -77,22 +270,26 @@ class SoftHistogramLoss(torch.nn.Module):
                 desired_hist_image = desired_hist_image[:,self.desired_hist_image_mask,:]
             # The bins are now simply the multi-dimensional pixels/patches. So now I remove redundant bins, by checking if there is duplicacy:
             # if patch_size==1:#Otherwise I already did this step before for each image version, and I avoid repeating this pruning for the entire patches collection for memory limitation reasons.
-            self.bins = self.Desired_Im_2_Bins(desired_hist_image)
+            self.bins,self.bin_multiplicities = self.Desired_Im_2_Bins(desired_hist_image)
         if not dictionary_not_histogram:
             self.loss = torch.nn.KLDivLoss()
         if patch_size>1:
-            self.patch_extraction_mat = ReturnPatchExtractionMat(input_im_HR_mask.data.cpu().numpy(),patch_size=patch_size,device=self.device,patches_overlap=0.5)#.to(self.device)
+            self.patch_extraction_mat = Return_Patch_Extractor(input_im_HR_mask.data.cpu().numpy(),patch_size=patch_size,device=self.device,patches_overlap=0.5)
             self.image_mask = None
         else:
             self.image_mask = input_im_HR_mask.view([-1]).type(torch.ByteTensor) if input_im_HR_mask is not None else None
         self.dictionary_not_histogram = dictionary_not_histogram
+        # Optionally evaluating the dictionary KDE of each patch only over its (approximately) top_k nearest bins, found using a k-means codebook:
+        self.dictionary_top_k = dictionary_top_k
+        self.dictionary_index = None
+        if dictionary_not_histogram and dictionary_top_k is not None and self.KDE and self.bins.size(-1)>=max(self.ANN_MIN_BINS,dictionary_top_k):
+            self.dictionary_index = Dictionary_Index(self.bins.view([self.bins.size(0),-1]),chunk_elements=self.CHUNK_ELEMENTS)
         if not dictionary_not_histogram:
+            self.desired_hist_image = desired_hist_image # Also used for calibrating the temperature
             if not automatic_temperature and desired_hist_image is not None:
                 with torch.no_grad():
                     self.desired_hists_list = [self.ComputeSoftHistogram(desired_hist_image,image_mask=self.desired_hist_image_mask,return_log_hist=False,
                                                                   reshape_image=False,compute_hist_normalizer=True).detach()]
-            else:
-                self.desired_hist_image = desired_hist_image
 
     def Feed_Desired_Hist_Im(self,desired_hist_image):
         self.desired_hists_list = []
@@ -104,101 +301,134 @@ class SoftHistogramLoss(torch.nn.Module):
                                                                   reshape_image=False,compute_hist_normalizer=True).detach())
 
     def Desired_Im_2_Bins(self,desired_im):
-        image_2_big = True
-        num_sub_images = 1
-        while image_2_big:
-            try:
-                bins = []
-                sub_image_sizes = [desired_im.size(1)//num_sub_images]*(num_sub_images-1)
-                sub_image_sizes += ([desired_im.size(1)-sum(sub_image_sizes)] if desired_im.size(1)-sum(sub_image_sizes)>0 else [])
-                sub_images = torch.split(desired_im,sub_image_sizes,dim=1)
-                for im in sub_images:
-                    repeated_elements_mat = (im.view([self.num_dims, -1, 1]) - im.view([im.size(0)] + [1, -1])).abs()
-                    repeated_elements_mat = (repeated_elements_mat < self.bin_width / 2).all(0)
-                    repeated_elements_mat = torch.mul(repeated_elements_mat,(1 - torch.diag(torch.ones([repeated_elements_mat.size(0)]))).type(
-                                                          repeated_elements_mat.dtype).to(repeated_elements_mat.device))
-                    repeated_elements_mat = torch.triu(repeated_elements_mat).any(1) ^ 1
-                    bins.append(im[:, repeated_elements_mat])
-                del repeated_elements_mat
-                image_2_big = False
-            except:
-                num_sub_images += 1
-                print('Hist bin pruning failed, retrying with %d sub-images' % (num_sub_images))
-        # if prune_only:
-        #     return bins
-        bins = [b.view([desired_im.size(0), 1, -1]).type(torch.cuda.DoubleTensor) for b in bins]
-        return torch.cat(bins,-1)
+        # Merging pixels/patches falling in the same cell of a grid with bin_width/2 spacing (so that merged elements differ by less than bin_width/2 in every dimension), by
+        # sorting their quantized values. Returns the merged bins (cell means) and their multiplicities, used for weighting the bins in the dictionary KDE:
+        desired_im = desired_im.view([desired_im.size(0),-1]).type(torch.cuda.DoubleTensor)
+        quantized = torch.floor(desired_im/(self.bin_width/2)).long()
+        _,bin_indexes,multiplicities = torch.unique(quantized,dim=1,return_inverse=True,return_counts=True)
+        bins = torch.zeros([desired_im.size(0),multiplicities.size(0)]).type(desired_im.dtype).to(desired_im.device).index_add_(1,bin_indexes,desired_im)
+        bins = bins/multiplicities.type(bins.dtype).unsqueeze(0)
+        return bins.view([desired_im.size(0),1,-1]).type(self.dtype),multiplicities
 
     def TemperatureSearch(self,desired_image,initial_image,desired_KL_div):
-        log_temperature_range = [0.1,1]
+        # Setting the temperature for which the KL div. between the soft histograms of initial_image (an image, as in forward) and desired_image (num_dims x pixels x 1) is desired_KL_div.
+        # The bisection probes are evaluated on pixel subsamples, whose kernel distances are computed once and only rescaled per probed temperature. The found temperature is
+        # then checked at full resolution, resuming the bisection there (around it) in case its KL div. is off.
+        with torch.no_grad():
+            if self.gray_scale:
+                initial_image = initial_image.mean(0,keepdim=True)
+            desired_image,initial_image = desired_image.type(self.dtype),self.Reshape_Image(initial_image,self.image_mask)
+            distances = [self.Calibration_Distances(desired_image),self.Calibration_Distances(initial_image)]
+            def Subsampled_KL_Div(temperature):
+                desired_im_hist = self.Normalize_Log_Hist(torch.logsumexp(-distances[0]/temperature,0)-np.log(distances[0].size(0)),desired_image.size(1),
+                                                          return_log_hist=False,compute_hist_normalizer=True)
+                initial_image_hist = self.Normalize_Log_Hist(torch.logsumexp(-distances[1]/temperature,0)-np.log(distances[1].size(0)),initial_image.size(1),
+                                                             return_log_hist=True,compute_hist_normalizer=False)
+                return self.loss(initial_image_hist,desired_im_hist).item()
+            def KL_Div(temperature):
+                desired_im_hist = self.ComputeSoftHistogram(desired_image,image_mask=self.desired_hist_image_mask,return_log_hist=False,reshape_image=False,compute_hist_normalizer=True,
+                                                            temperature=temperature)
+                initial_image_hist = self.ComputeSoftHistogram(initial_image,image_mask=None,return_log_hist=True,reshape_image=False,compute_hist_normalizer=False,temperature=temperature)
+                return self.loss(initial_image_hist,desired_im_hist).item()
+            temperature,num_probes = self.Temperature_Bisection(Subsampled_KL_Div,desired_KL_div,log_temperature_range=[0.1,1])
+            if distances[0].size(0)<desired_image.size(1) or distances[1].size(0)<initial_image.size(1):
+                temperature,num_full_probes = self.Temperature_Bisection(KL_Div,desired_KL_div,log_temperature_range=[np.log(temperature)-1,np.log(temperature)+1])
+                print('Temperature search used %d subsampled and %d full resolution KL div. evaluations'%(num_probes,num_full_probes))
+            print('Automatically set histogram temperature to %.3e'%(temperature))
+            self.temperature = torch.tensor(temperature).type(torch.cuda.DoubleTensor)
+            self.desired_hists_list = [self.ComputeSoftHistogram(desired_image,image_mask=self.desired_hist_image_mask,return_log_hist=False,reshape_image=False,
+                                                                 compute_hist_normalizer=True).detach()]
+
+    def Temperature_Bisection(self,KL_div,desired_KL_div,log_temperature_range):
+        # Bisection in log-temperature, first expanding the range until it contains the desired KL div. Returns the found temperature and the number of evaluated KL_div(temperature):
         STEP_SIZE = 10
         KL_DIV_TOLERANCE = 0.1
         cur_KL_div = []
         desired_temp_within_range = False
-        with torch.no_grad():
-            while True:
-                next_temperature = np.exp(np.mean(log_temperature_range))
-                if np.isinf(next_temperature) or next_temperature==0:
-                    print('KL div. is %.3e even for temperature of %.3e, aborting temperature search with that.'%(cur_KL_div[-1],self.temperature))
-                    break
-                self.temperature = 1*next_temperature
-                desired_im_hist = self.ComputeSoftHistogram(desired_image,image_mask=self.desired_hist_image_mask,return_log_hist=False,reshape_image=False,compute_hist_normalizer=True)
-                initial_image_hist = self.ComputeSoftHistogram(initial_image,image_mask=self.image_mask,return_log_hist=True,reshape_image=False,compute_hist_normalizer=False)
-                cur_KL_div.append(self.loss(initial_image_hist,desired_im_hist).item())
-                KL_div_too_big = cur_KL_div[-1] > desired_KL_div
-                if np.abs(np.log(max([0,cur_KL_div[-1]])/desired_KL_div))<=np.log(1+KL_DIV_TOLERANCE):
-                    print('Automatically set histogram temperature to %.3e'%(self.temperature))
-                    break
-                elif not desired_temp_within_range:
-                    if len(cur_KL_div)==1:
-                        initial_KL_div_too_big = KL_div_too_big
-                    else:
-                        desired_temp_within_range = initial_KL_div_too_big^KL_div_too_big
-                    if not desired_temp_within_range:
-                        if KL_div_too_big:
-                            log_temperature_range[1] += STEP_SIZE
-                        else:
-                            log_temperature_range[0] -= STEP_SIZE
-                if desired_temp_within_range:
+        temperature = 1*self.temperature # Kept if the search aborts before evaluating any temperature
+        while True:
+            next_temperature = np.exp(np.mean(log_temperature_range))
+            if np.isinf(next_temperature) or next_temperature==0:
+                print('KL div. is %.3e even for temperature of %.3e, aborting temperature search with that.'%(cur_KL_div[-1] if len(cur_KL_div)>0 else np.nan,next_temperature))
+                break
+            temperature = 1*next_temperature
+            cur_KL_div.append(KL_div(temperature))
+            KL_div_too_big = cur_KL_div[-1] > desired_KL_div
+            if np.abs(np.log(max([0,cur_KL_div[-1]])/desired_KL_div))<=np.log(1+KL_DIV_TOLERANCE):
+                break
+            elif not desired_temp_within_range:
+                if len(cur_KL_div)==1:
+                    initial_KL_div_too_big = KL_div_too_big
+                else:
+                    desired_temp_within_range = initial_KL_div_too_big^KL_div_too_big
+                if not desired_temp_within_range:
                     if KL_div_too_big:
-                        log_temperature_range[0] = 1*np.log(self.temperature)
+                        log_temperature_range[1] += STEP_SIZE
                     else:
-                        log_temperature_range[1] = 1*np.log(self.temperature)
+                        log_temperature_range[0] -= STEP_SIZE
+            if desired_temp_within_range:
+                if KL_div_too_big:
+                    log_temperature_range[0] = 1*np.log(temperature)
+                else:
+                    log_temperature_range[1] = 1*np.log(temperature)
+        return temperature,len(cur_KL_div)
+
+    def Calibration_Distances(self,image):
+        # Mean powered kernel distances (pixels x bins) of the pixels/patches of image (num_dims x pixels x 1) from the bins, i.e. the negated log kernel values for a temperature
+        # of 1. Images with more than CALIBRATION_ELEMENTS/bins pixels are subsampled, stratifying their pixels by their mean values and taking a random pixel from each stratum:
+        image,bins = image.view([image.size(0),-1]),self.bins.view([-1,self.bins.size(-1)])
+        num_samples = max(1,self.CALIBRATION_ELEMENTS//bins.size(1))
+        if image.size(1)>num_samples:
+            strata = (torch.arange(num_samples+1).to(image.device)*image.size(1))//num_samples
+            samples = strata[:-1]+(torch.rand([num_samples]).to(image.device)*(strata[1:]-strata[:-1]).float()).long()
+            image = image[:,torch.argsort(image.mean(0))[samples]]
+        pixels_chunk = max(1,self.CHUNK_ELEMENTS//(image.size(0)*bins.size(1)))
+        return torch.cat([-Chunked_Soft_Histogram.Log_Kernel(image[:,p:p+pixels_chunk].unsqueeze(2)-bins.unsqueeze(1),(1.,self.max,self.exp_power,self.SQRT_EPSILON))[0]
+                          for p in range(0,image.size(1),pixels_chunk)],0)
+
+    def Reshape_Image(self,image,image_mask):
+        # Returns the (num_dims x pixels x 1) pixels/patches of image:
+        if self.patch_size > 1:
+            image = self.patch_extraction_mat(image).view([self.num_dims, -1])
+            if self.no_patch_DC:
+                image = image-torch.mean(image,dim=0,keepdim=True)
+                if self.no_patch_STD:
+                    image = image / torch.max(torch.std(image, dim=0, keepdim=True), other=torch.tensor(1 / 255).to(self.device))*self.mean_patches_STD
+        else:
+            image = image.contiguous().view([self.num_dims,-1])
+            if image_mask is not None:
+                image = image[:, image_mask]
+        return image.unsqueeze(-1).type(self.dtype)
 
     def ComputeSoftHistogram(self,image,image_mask,return_log_hist,reshape_image,compute_hist_normalizer,temperature=None):
         CANONICAL_KDE_4_DICTIONARY = True
         if temperature is None:
             temperature = 1*self.temperature
         if not reshape_image:
-            image = image.type(torch.cuda.DoubleTensor)
+            image = image.type(self.dtype)
         else:
-            if self.patch_size > 1:
-                image = torch.sparse.mm(self.patch_extraction_mat, image.view([-1, 1])).view([self.num_dims, -1])
-                if self.no_patch_DC:
-                    image = image-torch.mean(image,dim=0,keepdim=True)
-                    if self.no_patch_STD:
-                        image = image / torch.max(torch.std(image, dim=0, keepdim=True), other=torch.tensor(1 / 255).to(self.device))*self.mean_patches_STD
-            else:
-                image = image.contiguous().view([self.num_dims,-1])
-                if image_mask is not None:
-                    image = image[:, image_mask]
-            image = image.unsqueeze(-1).type(torch.cuda.DoubleTensor)
-        hist = (image-self.bins).abs()
-        hist = torch.min(hist,(image-self.bins-self.max).abs())
-        hist = torch.min(hist,(image-self.bins+self.max).abs())
-        if not self.dictionary_not_histogram or CANONICAL_KDE_4_DICTIONARY:
-            hist = -((hist+self.SQRT_EPSILON)**self.exp_power)/temperature
-        hist = hist.mean(0)
+            image = self.Reshape_Image(image,image_mask)
         if self.dictionary_not_histogram and not CANONICAL_KDE_4_DICTIONARY:
             # return torch.exp(self.bin_width/(hist+self.bin_width/2))
-            return hist.min(dim=1)[0].view([1,-1])
+            return self.Dense_Distances(image).mean(0).min(dim=1)[0].view([1,-1])
             # return hist.min(dim=1)[0].view([1, -1])
-        if self.dictionary_not_histogram and CANONICAL_KDE_4_DICTIONARY:
-            return -1*torch.log(torch.exp(hist).mean(1)).view([1, -1])
-        hist = torch.exp(hist).mean(0)
+        if self.dictionary_index is not None:
+            return self.Top_K_Dictionary_KDE(image,temperature).view([1,-1])
+        if self.temperature_optimizer:# Differentiating w.r.t. the temperature (and twice w.r.t. the image) requires the dense computation
+            log_kernel = (-((self.Dense_Distances(image)+self.SQRT_EPSILON)**self.exp_power)/temperature).mean(0)
+            hist = -1*(torch.logsumexp(log_kernel,1)-np.log(log_kernel.size(1))) if self.dictionary_not_histogram else torch.logsumexp(log_kernel,0)-np.log(log_kernel.size(0))
+        else:
+            hist = Chunked_Soft_Histogram.apply(image.view([image.size(0),-1]),self.bins.view([-1,self.bins.size(-1)]),self.bin_multiplicities,float(temperature),self.max,self.exp_power,
+                                                self.SQRT_EPSILON,self.dictionary_not_histogram,self.CHUNK_ELEMENTS)
+        if self.dictionary_not_histogram:
+            return hist.view([1, -1])
+        return self.Normalize_Log_Hist(hist,image.size(1),return_log_hist=return_log_hist,compute_hist_normalizer=compute_hist_normalizer)
+
+    def Normalize_Log_Hist(self,hist,num_pixels,return_log_hist,compute_hist_normalizer):
+        # hist holds the log of the bins values (mean kernel values over num_pixels pixels), which are normalized before leaving the log domain:
         if compute_hist_normalizer or not self.KDE:
-            self.normalizer = hist.sum()/image.size(1)
-        hist = (hist/self.normalizer/image.size(1)).type(torch.cuda.FloatTensor)
+            self.log_normalizer = torch.logsumexp(hist,0)-np.log(num_pixels)
+        hist = torch.exp(hist-self.log_normalizer-np.log(num_pixels)).type(torch.cuda.FloatTensor)
         if self.KDE: # Adding another "bin" to account for all other missing bins
             hist = torch.cat([hist,(1-torch.min(torch.tensor(1).type(hist.dtype).to(hist.device),hist.sum())).view([1])])
         if return_log_hist:
@@ -206,6 +436,21 @@ class SoftHistogramLoss(torch.nn.Module):
         else:
             return hist.view([1,-1])
 
+    def Top_K_Dictionary_KDE(self,image,temperature):
+        # Approximating each patch's dictionary KDE by its dominant terms, those of the top_k nearest bins. Normalizing by the weights of all bins bounds the exact values from above:
+        image = image.view([image.size(0),-1])
+        candidates,valid = self.dictionary_index.Top_K(image.detach(),self.dictionary_top_k)
+        log_weights = torch.log(self.bin_multiplicities.type(image.dtype)/self.bin_multiplicities.sum())[candidates]
+        log_weights = torch.where(valid,log_weights,-float('inf')*torch.ones_like(log_weights))
+        return Top_K_Soft_Histogram.apply(image,self.bins.view([self.bins.size(0),-1]),candidates,log_weights,float(temperature),self.max,self.exp_power,self.SQRT_EPSILON,
+                                          self.CHUNK_ELEMENTS)
+
+    def Dense_Distances(self,image):
+        # Cyclic distances between all image pixels/patches and all bins (num_dims x pixels x bins):
+        distances = (image-self.bins).abs()
+        distances = torch.min(distances,(image-self.bins-self.max).abs())
+        return torch.min(distances,(image-self.bins+self.max).abs())
+
     def forward(self,cur_images):
         cur_images_hists,KLdiv_grad_sizes = [],[]
         for i,cur_image in enumerate(cur_images):
@@ -227,46 +472,215 @@ class SoftHistogramLoss(torch.nn.Module):
         else:
             return self.loss(torch.cat(cur_images_hists,0),torch.cat(self.desired_hists_list,0)).type(torch.cuda.FloatTensor)
 
-def ReturnPatchExtractionMat(mask,patch_size,device,patches_overlap=1,return_non_covered=False):
-    RANDOM_PATCHES_SELECTION = False #If true, patches are dropped in a random order, satisfying the maximal overlap constraint, rather than moving columns first ,than rows. This typically discards of much more patches.
-    mask = binary_opening(mask, np.ones([patch_size, patch_size]).astype(np.bool))
-    patches_indexes = extract_patches_2d(np.multiply(mask, 1 + np.arange(mask.size).reshape(mask.shape)),
-                                         (patch_size, patch_size)).reshape([-1, patch_size**2])
-    patches_indexes = patches_indexes[np.all(patches_indexes > 0, 1), :] - 1
+class Patch_Extractor:
+    # Gathers image pixels at precomputed (flattened) indexes. For patches, returns a (patch_size**2 x patches) tensor, given an image of the mask's size (e.g. 1 x H x W):
+    def __init__(self,indexes,device):
+        self.indexes = torch.from_numpy(indexes).long().to(device)
+        self.num_patches = self.indexes.size(1)
+
+    def __call__(self,image):
+        return image.reshape([-1])[self.indexes]
+
+PATCH_EXTRACTORS = LRU_Cache(max_size=32)
+
+def Array_Hash(array):
+    if torch.is_tensor(array):
+        array = array.detach().cpu().numpy()
+    array = np.ascontiguousarray(array)
+    return hashlib.sha1(array.tobytes()+str((array.shape,array.dtype)).encode()).hexdigest()
+
+def Return_Patch_Extractor(mask,patch_size,device,patches_overlap=1,return_non_covered=False):
+    # Memoized, since the same masks are used over and over when constructing objectives:
+    key = (Array_Hash(mask),patch_size,patches_overlap,return_non_covered,str(device))
+    return PATCH_EXTRACTORS.get(key,lambda:Compute_Patch_Extractor(mask,patch_size,device,patches_overlap,return_non_covered))
+
+def Compute_Patch_Extractor(mask,patch_size,device,patches_overlap,return_non_covered):
+    mask = binary_opening(mask, np.ones([patch_size, patch_size]).astype(bool))
+    window = np.ones([patch_size,patch_size]).astype(np.int32)
+    valid_patches = convolve2d(mask.astype(np.int32),window,mode='valid')==patch_size**2 # Patches (indexed by their top-left pixel) entirely within the mask
+    selected_patches = 1*valid_patches
     if patches_overlap<1:
-        # I discard patches by discarding those containing too many pixels that are already covered by a previous patch. Patches are ordered right to left, top to bottom.
-        # For exampe, if the stride corresponds to one row/column, it would be one row. There might be simpler ways to achieve this...
-        unique_indexes = list(set(list(patches_indexes.reshape([-1]))))
-        min_index = min(unique_indexes)
-        index_taken_indicator = np.zeros([max(unique_indexes) - min(unique_indexes)]).astype(np.bool)
-        valid_patches = np.ones([patches_indexes.shape[0]]).astype(np.bool)
-        randomized_patches_indexes = np.random.permutation(patches_indexes.shape[0])
-        oredered_patches_indexes = randomized_patches_indexes if RANDOM_PATCHES_SELECTION else np.arange(patches_indexes.shape[0])
-        for patch_num in oredered_patches_indexes:
-            if (patches_overlap==0 and np.any(index_taken_indicator[patches_indexes[patch_num,:] - min_index - 1]))\
-                    or np.mean(index_taken_indicator[patches_indexes[patch_num,:] - min_index - 1])>patches_overlap:
-                valid_patches[patch_num] = False
-                continue
-            index_taken_indicator[patches_indexes[patch_num,:] - min_index - 1] = True
-        patches_indexes = patches_indexes[valid_patches]
-        print('%.3f of desired pixels are covered by assigned patches'%(index_taken_indicator[unique_indexes-min_index-1].mean()))
-        if return_non_covered:
-            non_covered_indexes = np.array(unique_indexes)
-            non_covered_indexes = non_covered_indexes[np.logical_not(index_taken_indicator[non_covered_indexes - min_index - 1])]
-            non_covered_pixels_extraction_mat = Patch_Indexes_2_Sparse_Mat(non_covered_indexes,mask.size,device)
-    patch_extraction_mat = Patch_Indexes_2_Sparse_Mat(patches_indexes,mask.size,device)
-    if return_non_covered:
-        if not patches_overlap<1:
-            non_covered_pixels_extraction_mat = None#torch.sparse.FloatTensor(torch.Size([0, mask.size]))
-        return patch_extraction_mat,non_covered_pixels_extraction_mat
-    else:
-        return patch_extraction_mat
-
-def Patch_Indexes_2_Sparse_Mat(patches_indexes,mask_size,device):
-    corresponding_mat_rows = np.arange(patches_indexes.size).reshape([-1])
-    return torch.sparse.FloatTensor(
-        torch.LongTensor([corresponding_mat_rows, patches_indexes.transpose().reshape([-1])]),
-        torch.FloatTensor(np.ones([corresponding_mat_rows.size])), torch.Size([patches_indexes.size, mask_size])).to(device)
+        # Keeping only patches on a grid, with the stride making each patch share at most patches_overlap of its pixels with its preceding neighbor along each axis. E.g. an
+        # overlap of an entire patch but one row/column corresponds to a stride of 1, and no overlap to a stride of patch_size. The grid starts at the first valid patch position
+        # along each axis, and also includes the last one, so that the valid patches' bounding box is covered regardless of its alignment with the stride:
+        stride = max(1,int(np.ceil(np.round(patch_size*(1-patches_overlap),6))))
+        on_grid = np.zeros_like(valid_patches)
+        if np.any(valid_patches):
+            grid_rows,grid_cols = [np.unique(np.concatenate([np.arange(np.min(positions),np.max(positions)+1,stride),[np.max(positions)]]))
+                for positions in np.nonzero(valid_patches)]
+            on_grid[grid_rows.reshape([-1,1]),grid_cols.reshape([1,-1])] = True
+        selected_patches = np.logical_and(valid_patches,on_grid)
+        covered_pixels = convolve2d(selected_patches.astype(np.int32),window,mode='full')>0
+        valid_pixels = convolve2d(valid_patches.astype(np.int32),window,mode='full')>0
+        print('%.3f of desired pixels are covered by assigned patches'%(covered_pixels[valid_pixels].mean()))
+    patch_rows,patch_cols = np.nonzero(selected_patches)
+    pixel_offsets = (mask.shape[1]*np.arange(patch_size).reshape([-1,1])+np.arange(patch_size).reshape([1,-1])).reshape([-1,1])
+    patch_extractor = Patch_Extractor(pixel_offsets+(mask.shape[1]*patch_rows+patch_cols).reshape([1,-1]),device)
+    if not return_non_covered:
+        return patch_extractor
+    non_covered_pixels_extractor = None
+    if patches_overlap<1:
+        non_covered_indexes = np.nonzero(np.logical_and(valid_pixels,np.logical_not(covered_pixels)).reshape([-1]))[0]
+        if non_covered_indexes.size>0:
+            non_covered_pixels_extractor = Patch_Extractor(non_covered_indexes.reshape([-1,1]),device)
+    return patch_extractor,non_covered_pixels_extractor
+
+class Local_Patch_Statistics:
+    # Statistics of the patches selected by a Patch_Extractor, for a batch of single channel images (batch x H x W), without extracting the patches. Computed in float64, to avoid
+    # the cancellation errors of subtracting sums of squares:
+    # - STD: Each patch's standard deviation (unbiased, as torch.std), from integral images, in O(1) per patch regardless of the patch size. Returns a (patches x batch) tensor.
+    # - Mean_Squared_Distance: The mean squared difference of the patches from the desired patches (set using Set_Desired_Patches), per image. Expanding the square, it is a
+    #   per-pixel quadratic, weighted by the number of patches containing each pixel.
+    def __init__(self,patch_extractor,patch_size,image_size):
+        self.patch_extractor,self.patch_size,self.image_size = patch_extractor,patch_size,list(image_size)
+        top_left_pixels = patch_extractor.indexes[0]
+        self.rows,self.cols = top_left_pixels//self.image_size[1],top_left_pixels%self.image_size[1]
+
+    def Window_Sums(self,images):
+        integral = torch.nn.functional.pad(torch.cumsum(torch.cumsum(images,1),2),(1,0,1,0))
+        rows,cols,size = self.rows,self.cols,self.patch_size
+        return integral[:,rows+size,cols+size]-integral[:,rows,cols+size]-integral[:,rows+size,cols]+integral[:,rows,cols]
+
+    def STD(self,images):
+        images_dtype,images = images.dtype,images.double()
+        num_pixels = self.patch_size**2
+        variance = (self.Window_Sums(images**2)-self.Window_Sums(images)**2/num_pixels)/(num_pixels-1)
+        return torch.sqrt(torch.clamp(variance,min=0)).t().type(images_dtype)
+
+    def Set_Desired_Patches(self,desired_patches):
+        # desired_patches is a (patch_size**2 x patches) tensor, corresponding to the patch extractor's output:
+        desired_patches = desired_patches.detach().double().reshape([-1])
+        indexes = self.patch_extractor.indexes.reshape([-1])
+        self.coverage = torch.zeros([np.prod(self.image_size)],dtype=torch.float64,device=indexes.device).scatter_add_(0,indexes,torch.ones_like(desired_patches)).view(self.image_size)
+        self.desired_sums = torch.zeros([np.prod(self.image_size)],dtype=torch.float64,device=indexes.device).scatter_add_(0,indexes,desired_patches).view(self.image_size)
+        self.desired_squares_sum = (desired_patches**2).sum()
+
+    def Mean_Squared_Distance(self,images):
+        images_dtype,images = images.dtype,images.double()
+        squares_sum = (self.coverage*images**2-2*self.desired_sums*images).sum(dim=(1,2))+self.desired_squares_sum
+        return (squares_sum/self.patch_extractor.indexes.numel()).type(images_dtype)
+
+class Z_Store:
+    # Persistent store of optimized (pre-tanh) Zs, for warm-starting Z optimization with the same LR image, model checkpoint, objective, mask and objective target (e.g. desired image,
+    # scribble, STD increment or periodicity points).
+    # Each entry is a file in the store folder. Least recently used entries are evicted once the store exceeds max_size_MB:
+    STORED_Z_DTYPE = torch.float16 # Compact storage. Pre-tanh Zs are only used as initializations, so this precision suffices
+    def __init__(self,folder,max_size_MB=256,store_optimizer_state=False):
+        self.folder = folder
+        self.max_size_MB = max_size_MB
+        self.store_optimizer_state = store_optimizer_state
+        self.checkpoint_hashes = {}
+        os.makedirs(folder,exist_ok=True)
+
+    def Checkpoint_Hash(self,checkpoint_path):
+        if checkpoint_path is None:
+            return 'None'
+        file_stats = os.stat(checkpoint_path)
+        cache_key = (os.path.abspath(checkpoint_path),file_stats.st_mtime,file_stats.st_size)
+        if cache_key not in self.checkpoint_hashes:
+            checkpoint_hash = hashlib.sha1()
+            with open(checkpoint_path,'rb') as f:
+                for chunk in iter(lambda:f.read(2**20),b''):
+                    checkpoint_hash.update(chunk)
+            self.checkpoint_hashes[cache_key] = checkpoint_hash.hexdigest()
+        return self.checkpoint_hashes[cache_key]
+
+    def Key(self,LR_image,checkpoint_path,objective,mask=None,target_data=None):
+        return hashlib.sha1('_'.join([Array_Hash(LR_image),self.Checkpoint_Hash(checkpoint_path),objective,'None' if mask is None else Array_Hash(mask),
+                                      self.Data_Hash(target_data)]).encode()).hexdigest()
+
+    def Data_Hash(self,data):
+        # Hashing the (possibly nested) data entries defining the objective's target:
+        if isinstance(data,dict):
+            return hashlib.sha1('_'.join(['%s:%s'%(key,self.Data_Hash(data[key])) for key in sorted(data.keys())]).encode()).hexdigest()
+        if isinstance(data,(list,tuple)):
+            return hashlib.sha1('_'.join([self.Data_Hash(value) for value in data]).encode()).hexdigest()
+        if torch.is_tensor(data) or isinstance(data,np.ndarray):
+            return Array_Hash(data)
+        return repr(data)
+
+    def Entry_Path(self,key):
+        return os.path.join(self.folder,key+'.pth')
+
+    def Get(self,key):
+        if not os.path.isfile(self.Entry_Path(key)):
+            return None
+        os.utime(self.Entry_Path(key)) # Marking the entry as recently used
+        entry = torch.load(self.Entry_Path(key),map_location='cpu')
+        entry['pre_tanh_Z'] = entry['pre_tanh_Z'].float()
+        return entry
+
+    def Put(self,key,pre_tanh_Z,optimizer=None):
+        entry = {'pre_tanh_Z':pre_tanh_Z.detach().cpu().type(self.STORED_Z_DTYPE)}
+        if self.store_optimizer_state and optimizer is not None:
+            entry.update({'optimizer':type(optimizer).__name__,'optimizer_state':optimizer.state_dict(),'loss_scale':getattr(optimizer,'loss_scale',None)})
+        torch.save(entry,self.Entry_Path(key)+'.tmp')
+        os.replace(self.Entry_Path(key)+'.tmp',self.Entry_Path(key)) # Avoiding partially written entries
+        self.Evict()
+
+    def Evict(self):
+        entries = sorted([(os.path.getmtime(path),os.path.getsize(path),path) for path in glob(os.path.join(self.folder,'*.pth'))])
+        store_size = sum([entry[1] for entry in entries])
+        for _,entry_size,path in entries:
+            if store_size<=self.max_size_MB*2**20:
+                break
+            os.remove(path)
+            store_size -= entry_size
+
+class Z_Optimization_Profiler:
+    # Opt-in per-iteration profiling of Z_optimizer.optimize, passed to Z_optimizer as profiler. Each iteration's time is split among PHASES, by timing the intervals between
+    # consecutive Mark calls. Without sync_cuda, GPU work is attributed to the phase in which the CPU waits for it (e.g. the .item() calls in 'logging'), keeping the profiling cheap.
+    # With sync_cuda, CUDA is synchronized at every mark, for accurate per-phase GPU times. Records are kept in self.records, and written through logger (a Logger), when given.
+    # 'step' includes the L-BFGS line search evaluations, except for their feed_data, generator and loss phases.
+    PHASES = ['feed_data','generator','loss','logging','backward','step','other']
+
+    def __init__(self,logger=None,sync_cuda=False):
+        self.logger = logger
+        self.use_cuda = torch.cuda.is_available()
+        self.sync_cuda = sync_cuda and self.use_cuda
+        self.records,self.iteration = [],None
+
+    def Time(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def Start_Iteration(self,iteration,generator_forwards):
+        self.End_Iteration(generator_forwards)
+        if self.use_cuda:
+            torch.cuda.reset_peak_memory_stats()
+        self.iteration,self.iteration_start_forwards = iteration,generator_forwards
+        self.phase_times = dict([(phase,0.) for phase in self.PHASES])
+        self.iteration_start_time = self.latest_mark_time = self.Time()
+
+    def Mark(self,phase):
+        # Attributing the time since the latest mark to phase:
+        if self.iteration is None:
+            return
+        cur_time = self.Time()
+        self.phase_times[phase] += cur_time-self.latest_mark_time
+        self.latest_mark_time = cur_time
+
+    def End_Iteration(self,generator_forwards):
+        if self.iteration is None:
+            return
+        self.Mark('other')
+        record = dict([(phase+'_time',value) for phase,value in self.phase_times.items()])
+        record['iteration_time'] = self.latest_mark_time-self.iteration_start_time
+        record['generator_forwards'] = generator_forwards-self.iteration_start_forwards
+        record['forwards_per_sec'] = record['generator_forwards']/record['iteration_time']
+        if self.use_cuda:
+            record['peak_memory_MB'] = torch.cuda.max_memory_allocated()/2**20
+        self.records.append(dict(iteration=self.iteration,**record))
+        if self.logger is not None:
+            self.logger.print_format_results('val',dict({'epoch':0,'iters':self.iteration,'time':time.time(),'model':''},**record),dont_print=True)
+        self.iteration = None
+
+    def Summary(self):
+        # Mean of each recorded value over all iterations:
+        if len(self.records)==0:
+            return {}
+        return dict([(key,np.mean([record[key] for record in self.records])) for key in self.records[0].keys() if key!='iteration'])
 
 class Optimizable_Z(torch.nn.Module):
     def __init__(self,Z_shape,Z_range=None,initial_pre_tanh_Z=None,Z_mask=None,random_perturbations=False):
@@ -297,6 +711,11 @@ class Optimizable_Z(torch.nn.Module):
         else:
             return self.Z
 
+    def Mask_Grad(self):
+        # Zeroing the gradient w.r.t. Z entries outside the mask, which forward resets anyway:
+        if self.mask is not None and self.Z.grad is not None:
+            self.Z.grad.mul_(self.mask)
+
     def PreTanhZ(self):
         if self.mask is not None:
             return self.mask * self.Z.data + (1 - self.mask) * self.initial_pre_tanh_Z
@@ -323,8 +742,18 @@ def TV_Loss(image):
 class Z_optimizer():
     MIN_LR = 1e-5
     PATCH_SIZE_4_STD = 7
+    DICTIONARY_TOP_K = None # Optional number of (approximately) nearest dictionary bins used per patch, for large dictionaries (e.g. 32). None for always using all bins
+    PER_START_CONVERGENCE_WINDOW = 10 # Iterations window for determining the convergence of each start, when optimizing multiple Zs with a positive max_iters
+    DETACH_Y_FOR_CHROMA_TRAINING = False
+    OPTIMIZER_BACKENDS = ['Adam','LBFGS']
+    OBJECTIVES_OPTIMIZER_BACKEND = {} # Optimizer backend per objective, for objectives not using Adam (e.g. {'l1':'LBFGS','STD_increase':'LBFGS','desired_SVD':'LBFGS'})
+    LBFGS_HISTORY_SIZE = 10
+    DIVERSITY_CHUNK_ELEMENTS = 2**24 # Bounding the memory of computing the pairwise distances between outputs in the 'random' objectives
+    AUTO_TEMPERATURE_KL_DIV = None # When set, the automatic histogram temperature is calibrated to yield this initial KL div. (using SoftHistogramLoss.TemperatureSearch), rather than optimized for maximal KL div. gradients w.r.t. Z
+    CROPPED_GENERATOR_EVALUATION = True # Running the generator only on the region affected by the optimized part of Z (when masked), rather than on the entire image
     def __init__(self,objective,Z_size,model,Z_range,max_iters,data=None,loggers=None,image_mask=None,Z_mask=None,initial_Z=None,initial_LR=None,existing_optimizer=None,
-                 batch_size=1,HR_unpadder=None,auto_set_hist_temperature=False,random_Z_inits=False,jpeg_extractor=None,non_local_Z_optimization=False):
+                 batch_size=1,HR_unpadder=None,auto_set_hist_temperature=False,random_Z_inits=False,jpeg_extractor=None,non_local_Z_optimization=False,optimizer_backend=None,
+                 Z_store=None,profiler=None):
         self.jpeg_mode = jpeg_extractor is not None
         self.data_keys = {'reconstructed':'SR'} if not self.jpeg_mode else {'reconstructed':'Decomp'}
         if (initial_Z is not None or 'cur_Z' in model.__dict__.keys()):
@@ -356,6 +785,23 @@ class Z_optimizer():
             # Z_mask *= new_Z_mask
             Z_mask = 1*new_Z_mask
             Z_mask = np.minimum(1,Z_mask+dilated_im_mask)
+        self.Z_store,self.Z_store_key,stored_entry = Z_store,None,None
+        if Z_store is not None and data is not None and not self.model_training and 'random' not in objective: # The random objectives seek new alternatives, so they are not warm-started
+            self.Z_store_key = Z_store.Key(LR_image=data['LR'][:1],checkpoint_path=model.opt['path']['pretrained_model_G'],objective=objective,mask=image_mask,
+                                           target_data={key:value for key,value in data.items() if key not in ['LR','Z']})
+            stored_entry = Z_store.Get(self.Z_store_key)
+            if stored_entry is not None and list(stored_entry['pre_tanh_Z'].size())==[batch_size,model.num_latent_channels]+list(Z_size):
+                stored_pre_tanh_Z = stored_entry['pre_tanh_Z'].to(model.fake_H.device)
+                if initial_pre_tanh_Z is not None and Z_mask is not None: # Only warm-starting the optimized region, keeping the current Z elsewhere
+                    stored_pre_tanh_Z = torch.from_numpy(Z_mask).type(stored_pre_tanh_Z.dtype).to(stored_pre_tanh_Z.device)*(stored_pre_tanh_Z-initial_pre_tanh_Z.to(
+                        stored_pre_tanh_Z.device))+initial_pre_tanh_Z.to(stored_pre_tanh_Z.device)
+                initial_pre_tanh_Z,random_Z_inits = stored_pre_tanh_Z,False
+                print('Warm-starting Z optimization from a stored Z')
+            else:
+                stored_entry = None
+        self.generator_region = None
+        if self.CROPPED_GENERATOR_EVALUATION and Z_mask is not None and not np.all(Z_mask) and not self.model_training and not self.jpeg_mode and 'Adversarial' not in objective:
+            self.Set_Generator_Region(model,Z_mask,LR_size=list(data['LR'].size()[2:]))
         self.Z_model = Optimizable_Z(Z_shape=[batch_size,model.num_latent_channels] + list(Z_size), Z_range=Z_range,initial_pre_tanh_Z=initial_pre_tanh_Z,Z_mask=Z_mask,
             random_perturbations=(random_Z_inits and 'random' not in objective) or ('random' in objective and 'limited' in objective))
         assert (initial_LR is not None) or (existing_optimizer is not None),'Should either supply optimizer from previous iterations or initial LR for new optimizer'
@@ -385,10 +831,18 @@ class Z_optimizer():
                 self.constraining_loss_weight = 0.1 # Setting a default weight, that should probably be adjusted for each different tool
         if 'local' in objective:#Used in relative STD change and periodicity objective cases:
             desired_overlap = 1 if 'STD' in objective else 0.5
-            self.patch_extraction_map,self.non_covered_indexes_extraction_mat = ReturnPatchExtractionMat(mask=image_mask,
+            self.patch_extraction_map,self.non_covered_indexes_extraction_mat = Return_Patch_Extractor(mask=image_mask,
                 patch_size=self.PATCH_SIZE_4_STD,device=model.fake_H.device,patches_overlap=desired_overlap,return_non_covered=True)
+            self.local_statistics = Local_Patch_Statistics(self.patch_extraction_map,patch_size=self.PATCH_SIZE_4_STD,image_size=image_mask.shape)
             # self.patch_extraction_map, self.non_covered_indexes_extraction_mat =\
             #     self.patch_extraction_map.to(model.fake_H.device),self.non_covered_indexes_extraction_mat.to(model.fake_H.device)
+        if stored_entry is not None: # Computing the initial statistics (e.g. initial_STD) of the warm-start Z's output, rather than of the current output
+            with torch.no_grad():
+                model.feed_data(dict(data,Z=self.Z_model()),need_GT=False)
+                if self.generator_region is not None:
+                    self.Cropped_Generator_Forward()
+                else:
+                    model.test(chroma_input=data['chroma_input'] if 'chroma_input' in data.keys() else None)
         if not self.model_training:
             self.initial_STD = self.Masked_STD(first_image_only=True)
             print('Initial STD: %.3e' % (self.initial_STD.mean().item()))
@@ -443,10 +897,11 @@ class Z_optimizer():
                     self.loss = Scribble_Loss
                 # scheduler_threshold = 1e-2
             elif 'Mag' in objective:
-                self.desired_patches = torch.sparse.mm(self.patch_extraction_map, self.initial_output.mean(dim=1).view([-1, 1])).view([self.PATCH_SIZE_4_STD ** 2, -1])
+                self.desired_patches = self.patch_extraction_map(self.initial_output.mean(dim=1)).view([self.PATCH_SIZE_4_STD ** 2, -1])
                 desired_STD = torch.max(torch.std(self.desired_patches,dim=0,keepdim=True),torch.tensor(1/255).to(self.device))
                 self.desired_patches = (self.desired_patches-torch.mean(self.desired_patches,dim=0,keepdim=True))/desired_STD*\
                     (desired_STD+data['STD_increment']*(1 if 'increase' in objective else -1))+torch.mean(self.desired_patches,dim=0,keepdim=True)
+                self.local_statistics.Set_Desired_Patches(self.desired_patches)
                 self.constraining_loss_weight = 255/10*data['STD_increment']**2
             elif 'desired_SVD' in objective:
                 self.loss = FilterLoss(latent_channels='SVDinNormedOut_structure_tensor',constant_Z=data['desired_Z'],
@@ -495,6 +950,7 @@ class Z_optimizer():
                                 else:
                                     self.periodicity_points[-1].append(torch.from_numpy(np.stack(grid,-1)).view([1]+list(grid[0].shape)+[2]).type(
                                         self.initial_output.dtype).to(self.initial_output.device))
+                    self.Stack_Periodicity_Grids()
                 else:
                     self.periodicity_points = [np.array(point) for point in data['periodicity_points']]
             elif 'VGG' in objective and 'random' not in objective:
@@ -507,6 +963,7 @@ class Z_optimizer():
                 self.STD_PRESERVING_WEIGHT = 1e4
                 if self.automatic_temperature:
                     assert 'hist' in objective,'Unsupported  for dictionary'
+                if self.automatic_temperature and self.AUTO_TEMPERATURE_KL_DIV is None:
                     self.data['Z'] = self.Z_model()
                     pre_tanh_Z = self.Z_model.Z
                     pre_tanh_Z.requires_grad = True
@@ -531,7 +988,13 @@ class Z_optimizer():
                 self.loss = SoftHistogramLoss(bins=256,min=0,max=1,desired_hist_image=self.data['desired'] if self.data is not None else None,
                     desired_hist_image_mask=data['Desired_Im_Mask'] if self.data is not None else None,input_im_HR_mask=self.image_mask,
                     gray_scale=True,patch_size=6 if 'patch' in objective else 1,temperature=optimal_temperature,dictionary_not_histogram='dict' in objective,
-                    no_patch_DC='noDC' in objective,no_patch_STD='no_localSTD' in objective)
+                    no_patch_DC='noDC' in objective,no_patch_STD='no_localSTD' in objective,dictionary_top_k=self.DICTIONARY_TOP_K)
+                if self.automatic_temperature and self.AUTO_TEMPERATURE_KL_DIV is not None:
+                    self.data['Z'] = self.Z_model()
+                    model.feed_data(self.data, need_GT=False)
+                    with torch.no_grad():
+                        initial_image = model.netG(model.var_L).to(self.device)
+                    self.loss.TemperatureSearch(self.loss.desired_hist_image,initial_image[0],desired_KL_div=self.AUTO_TEMPERATURE_KL_DIV)
                 self.constraining_loss_weight = 10# if 'no_localSTD' in objective else 0.1 # Empirically set, based on empirically measured loss.
             elif 'Adversarial' in objective:
                 self.netD = model.netD
@@ -539,12 +1002,26 @@ class Z_optimizer():
             elif 'limited' in objective:
                 self.initial_image = 1*model.output_image.detach()
                 self.rmse_weight = data['rmse_weight']
-            self.optimizer = torch.optim.Adam(self.Z_model.parameters(), lr=initial_LR)
+            self.optimizer_backend = optimizer_backend if optimizer_backend is not None else self.OBJECTIVES_OPTIMIZER_BACKEND.get(objective,'Adam')
+            assert self.optimizer_backend in self.OPTIMIZER_BACKENDS,'Unsupported optimizer backend %s'%(self.optimizer_backend)
+            if self.optimizer_backend=='LBFGS': # Step sizes are determined by a strong-Wolfe line search, so initial_LR is not used:
+                self.optimizer = torch.optim.LBFGS(self.Z_model.parameters(),lr=1,max_iter=1,history_size=self.LBFGS_HISTORY_SIZE,line_search_fn='strong_wolfe')
+            else:
+                self.optimizer = torch.optim.Adam(self.Z_model.parameters(), lr=initial_LR)
+            if stored_entry is not None and stored_entry.get('optimizer')==type(self.optimizer).__name__:
+                self.optimizer.load_state_dict(stored_entry['optimizer_state'])
+                self.optimizer.loss_scale = stored_entry['loss_scale']
+                if self.optimizer_backend=='Adam':
+                    self.optimizer.param_groups[0]['lr'] = initial_LR
         else:
             self.optimizer = existing_optimizer
+            self.optimizer_backend = 'LBFGS' if isinstance(existing_optimizer,torch.optim.LBFGS) else 'Adam'
+        self.generator_forwards = 0
         self.LR = initial_LR
         self.scheduler = None#torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer=self.optimizer,verbose=True,threshold=1e-2,min_lr=self.MIN_LR,cooldown=10)
         self.loggers = loggers
+        self.profiler = profiler
+        self.iteration_callback = None # Called with the optimizer after every iteration. Returning True stops the optimization (e.g. for cancelling it)
         self.cur_iter = 0
         self.max_iters = max_iters
         self.random_Z_inits = 'all' if (random_Z_inits or self.model_training)\
@@ -555,13 +1032,11 @@ class Z_optimizer():
     def Masked_STD(self,first_image_only=False):
         model_output = self.model.Output_Batch(within_0_1=True)
         if 'local' in self.objective:
-            values_2_return = []
-            for im_num in range(1 if first_image_only else model_output.size(0)):
-                values_2_return.append(torch.sparse.mm(self.patch_extraction_map,model_output[im_num].mean(dim=0).view([-1, 1])).view([self.PATCH_SIZE_4_STD ** 2, -1]).std(dim=0))
-                if self.non_covered_indexes_extraction_mat is not None:
-                    values_2_return[-1] = torch.cat([values_2_return[-1],torch.sparse.mm(self.non_covered_indexes_extraction_mat,model_output[im_num].mean(dim=0).view(
-                    [-1, 1])).std(dim=0)], 0)
-            return torch.stack(values_2_return, 1)
+            images = model_output[:1] if first_image_only else model_output
+            values_2_return = self.local_statistics.STD(images.mean(dim=1))
+            if self.non_covered_indexes_extraction_mat is not None:
+                values_2_return = torch.cat([values_2_return,torch.stack([self.non_covered_indexes_extraction_mat(image.mean(dim=0)).std(dim=0) for image in images],1)],0)
+            return values_2_return
         else:
             return torch.std(model_output * self.image_mask, dim=(1, 2, 3)).view(1,-1)
 
@@ -573,6 +1048,45 @@ class Z_optimizer():
         elif 'hist' in self.objective:
             self.loss.Feed_Desired_Hist_Im(data['desired'].to(self.device))
 
+    def Set_Generator_Region(self,model,Z_mask,LR_size):
+        # Only output pixels within the generator's and projection's receptive field radius from the optimized (masked) Z region can change. Finding this region (in LR pixels),
+        # and computing the output for the initial Z, into which the output of this region would be pasted on every iteration:
+        netG = model.netG.module if isinstance(model.netG,torch.nn.DataParallel) else model.netG
+        if 'Region_Forward' not in dir(netG):
+            return
+        self.generator_margin = model.Generator_Margin_LR(model.netG)+netG.projection_margin_LR
+        Z_region = [np.min(np.argwhere(Z_mask),0),np.max(np.argwhere(Z_mask),0)+1]
+        region_start = [max(0,int(Z_region[0][axis])//model.Z_size_factor-self.generator_margin) for axis in range(2)]
+        region_end = [min(LR_size[axis],-(-int(Z_region[1][axis])//model.Z_size_factor)+self.generator_margin) for axis in range(2)]
+        if region_start==[0,0] and region_end==LR_size:
+            return
+        self.generator_region = (region_start,region_end)
+        model.netG.eval()
+        with torch.no_grad():
+            self.initial_generator_output = model.netG(model.model_input[:1]).detach()
+        model.netG.train()
+        print('Running the generator on a %dx%d region (out of %dx%d)'%(region_end[0]-region_start[0],region_end[1]-region_start[1],LR_size[0],LR_size[1]))
+
+    def Cropped_Generator_Forward(self):
+        netG = self.model.netG.module if isinstance(self.model.netG,torch.nn.DataParallel) else self.model.netG
+        netG.eval()
+        region_output = netG.Region_Forward(*netG.Pad_Input(self.model.model_input),*self.generator_region,self.generator_margin)
+        netG.train()
+        region_start,region_end = [[netG.ds_factor*val for val in corner] for corner in self.generator_region]
+        self.model.fake_H = self.initial_generator_output.repeat([region_output.size(0),1,1,1])
+        self.model.fake_H[:,:,region_start[0]:region_end[0],region_start[1]:region_end[1]] = region_output
+        self.model.output_image = 1*self.model.fake_H
+
+    def Profile(self,phase):
+        if self.profiler is not None:
+            self.profiler.Mark(phase)
+
+    def Active_Starts_Batch(self,value,active_starts):
+        # Reducing values having a row per start (optimized Z) to the rows of the still active starts:
+        if active_starts is None or not torch.is_tensor(value) or value.dim()==0 or value.size(0)!=self.Z_model.Z.size(0):
+            return value
+        return value[active_starts]
+
     def Manage_Model_Grad_Requirements(self,disable):
         if disable:
             self.original_requires_grad_status = []
@@ -583,12 +1097,107 @@ class Z_optimizer():
             for i, p in enumerate(self.model.netG.parameters()):
                 p.requires_grad = self.original_requires_grad_status[i]
 
+    def Per_Start_Z_Loss(self,cur_data,active_starts=None,frozen_starts=None,best_data_in_loss_domain=None,Uncomp_batch=None):
+        # Running the generator on the (active starts') Zs. Returns the loss of each start (or a single loss, for some objectives), and the outputs in the loss domain ('random' objectives only):
+        data_in_loss_domain = None
+        cur_data['Z'] = self.Active_Starts_Batch(self.Z_model(),active_starts)
+        if self.model_training and 'Uncomp' in self.data.keys():
+            self.data['Uncomp'] = 1*Uncomp_batch
+        self.generator_forwards += cur_data['Z'].size(0)
+        self.model.feed_data(cur_data, need_GT=False,detach_Y=self.DETACH_Y_FOR_CHROMA_TRAINING and self.model_training and self.data['Uncomp'].size(1)==3)
+        self.Profile('feed_data')
+        if self.generator_region is not None:
+            self.Cropped_Generator_Forward()
+        else:
+            self.model.test(prevent_grads_calc=False,chroma_input=cur_data['chroma_input'] if 'chroma_input' in cur_data.keys() else None)
+        self.output_image = self.model.Output_Batch(within_0_1=True)
+        if self.model_training:
+            self.output_image = self.HR_unpadder(self.output_image)
+        self.Profile('generator')
+        if 'random' in self.objective:
+            if 'l1' in self.objective:
+                data_in_loss_domain = self.output_image
+            elif 'VGG' in self.objective:
+                data_in_loss_domain = self.model.netF(self.output_image)
+            all_starts_in_loss_domain = data_in_loss_domain
+            if active_starts is not None: # Frozen starts still take part in the distances, using their outputs for their best Z:
+                all_starts_in_loss_domain = torch.cat([data_in_loss_domain,best_data_in_loss_domain[frozen_starts]],0)
+            Z_loss = Nearest_Neighbor_Distance.apply(all_starts_in_loss_domain,data_in_loss_domain,self.DIVERSITY_CHUNK_ELEMENTS)
+            if 'limited' in self.objective:
+                rmse = (data_in_loss_domain - self.Active_Starts_Batch(self.initial_image,active_starts)).abs()
+                Z_loss = Z_loss-self.rmse_weight*rmse
+            if self.Z_mask is not None:
+                Z_loss = Z_loss*self.Z_mask
+            Z_loss = -1*Z_loss.mean(dim=(1,2,3))
+        elif any([phrase in self.objective for phrase in ['l1','scribble']]):
+            Z_loss = self.loss(self.output_image.to(self.device), self.desired_im.to(self.device))
+        elif 'desired_SVD' in self.objective:
+            Z_loss = self.loss({'SR':self.output_image.to(self.device)}).mean()
+        elif any([phrase in self.objective for phrase in ['hist','dict']]):
+            Z_loss = self.loss(self.output_image.to(self.device))
+            if 'localSTD' in self.objective:
+                Z_loss = Z_loss+(self.STD_PRESERVING_WEIGHT*(self.Masked_STD(first_image_only=False)-self.initial_STD)**2).mean(0).to(self.device)
+        elif 'Adversarial' in self.objective:
+            Z_loss = self.loss(self.netD(self.model.DTE_net.HR_unpadder(self.output_image).to(self.device)),True)
+        elif 'STD' in self.objective and not any([phrase in self.objective for phrase in ['periodicity','TV']]):
+            Z_loss = self.Masked_STD(first_image_only=False)
+            if any([phrase in self.objective for phrase in ['increase', 'decrease']]):
+                Z_loss = (Z_loss-self.desired_STD)**2
+            Z_loss = Z_loss.mean(0)
+        elif 'Mag' in self.objective:
+            Z_loss = self.local_statistics.Mean_Squared_Distance(self.output_image.mean(dim=1))
+        elif 'periodicity' in self.objective:
+            Z_loss = self.PeriodicityLoss().to(self.device)
+            if 'Plus' in self.objective and self.PLUS_MEANS_STD_INCREASE:
+                Z_loss = Z_loss+self.STD_PRESERVING_WEIGHT*((self.Masked_STD(first_image_only=False)-self.desired_STD)**2).mean()
+        elif 'TV' in self.objective:
+            Z_loss = (self.STD_PRESERVING_WEIGHT*(self.Masked_STD(first_image_only=False)-self.initial_STD)**2).mean(0)+TV_Loss(self.output_image * self.image_mask).to(self.device)
+        elif 'VGG' in self.objective:
+            Z_loss = self.loss(self.model.netF(self.output_image).to(self.device),self.GT_HR_VGG)
+        if 'max' in self.objective:
+            Z_loss = -1*Z_loss
+        self.Profile('loss')
+        return Z_loss,data_in_loss_domain
+
+    def Total_Z_Loss(self,Z_loss,num_starts=None):
+        # Averaging over starts (normalizing by the number of all starts, when given), and adding the constraining loss:
+        Z_loss = Z_loss.mean() if num_starts is None else Z_loss.sum()/num_starts
+        if self.non_local_Z_optimization:
+            # if z_iter==self.cur_iter: #First iteration:
+            #     self.constraining_loss_weight = 255/10*Z_loss.item()
+            Z_loss = Z_loss+self.constraining_loss_weight*self.constraining_loss(self.output_image.to(self.device))
+        return Z_loss
+
+    def Line_Search_Closure(self,cur_data,Z_loss,Uncomp_batch=None):
+        # Closure for optimizers evaluating the loss multiple times per step: The first call returns the loss already computed (and backpropagated) for the current Z.
+        # Later (line search) evaluations are kept, to be reused if the step ends at one of them.
+        # The loss is scaled to have unit maximal gradient at the first step, as L-BFGS uses absolute tolerances, while Z losses and gradients are typically tiny. The scale is
+        # kept with the optimizer, to remain consistent with its curvature history.
+        # Gradients are masked, so that the search directions and curvature pairs only involve Z entries that are not reset by Z_model (when using Z_mask):
+        first_call = [True]
+        self.Z_model.Mask_Grad()
+        if getattr(self.optimizer,'loss_scale',None) is None:
+            self.optimizer.loss_scale = 1/max(self.Z_model.Z.grad.abs().max().item(),torch.finfo(self.Z_model.Z.dtype).tiny)
+        def closure():
+            if len(first_call)>0 and first_call.pop():
+                self.Z_model.Z.grad.mul_(self.optimizer.loss_scale)
+                return Z_loss.detach()*self.optimizer.loss_scale
+            self.optimizer.zero_grad()
+            evaluated_Z = 1*self.Z_model.Z.data
+            line_search_Z_loss = self.Per_Start_Z_Loss(cur_data,Uncomp_batch=Uncomp_batch)[0]
+            line_search_total_Z_loss = self.Total_Z_Loss(line_search_Z_loss)
+            line_search_total_Z_loss.backward()
+            self.Z_model.Mask_Grad()
+            self.line_search_evaluations.append((evaluated_Z,line_search_Z_loss.detach(),line_search_total_Z_loss.detach(),1*self.Z_model.Z.grad))
+            self.Z_model.Z.grad.mul_(self.optimizer.loss_scale)
+            return line_search_total_Z_loss.detach()*self.optimizer.loss_scale
+        return closure
+
     def optimize(self):
-        DETACH_Y_FOR_CHROMA_TRAINING = False
         if 'Adversarial' in self.objective:
             self.model.netG.train(True) # Preventing image padding in the CEM code, to have the output fit D's input size
         self.Manage_Model_Grad_Requirements(disable=True)
-        self.loss_values = []
+        self.loss_values,self.generator_forwards_history,self.line_search_evaluations = [],[],[]
         if self.random_Z_inits and self.cur_iter==0:
             self.Z_model.Randomize_Z(what_2_shuffle=self.random_Z_inits)
         z_iter = self.cur_iter
@@ -598,6 +1207,15 @@ class Z_optimizer():
             # does self.data['Uncomp'] get completely overridden, and therefore the optimizer "thinks" it need to use self.data['Uncomp'] in consecutive backward() steps. I solve it by
             # explicitly initializing self.data['Uncomp'] to its original value before each iteration.
             Uncomp_batch = 1*self.data['Uncomp']
+        else:
+            Uncomp_batch = None
+        # Per-start early stopping, when optimizing multiple Zs (starts) at once: Converged starts are frozen at their best Z so far, and dropped from the generator's batch.
+        num_starts = self.Z_model.Z.size(0)
+        per_start_stopping = num_starts>1 and not self.model_training and self.optimizer_backend!='LBFGS'
+        active_starts,frozen_starts,cur_data = None,None,self.data # active_starts is None as long as all starts are active
+        best_Z_losses,best_pre_tanh_Z,best_data_in_loss_domain = np.inf*np.ones([num_starts]),1*self.Z_model.Z.data,None
+        best_Z_losses_history = []
+        convergence_window = -self.max_iters if self.max_iters<0 else self.PER_START_CONVERGENCE_WINDOW
         while True:
             if self.max_iters>0:
                 if z_iter==(self.cur_iter+self.max_iters):
@@ -607,81 +1225,88 @@ class Z_optimizer():
                     break
                 if (self.loss_values[self.max_iters] - self.loss_values[-1]) / np.abs(self.loss_values[self.max_iters]) < 1e-2 * self.LR:
                     break
-            self.optimizer.zero_grad()
-            self.data['Z'] = self.Z_model()
-            if self.model_training and 'Uncomp' in self.data.keys():
-                self.data['Uncomp'] = 1*Uncomp_batch
-            self.model.feed_data(self.data, need_GT=False,detach_Y=DETACH_Y_FOR_CHROMA_TRAINING and self.model_training and self.data['Uncomp'].size(1)==3)
-            self.model.test(prevent_grads_calc=False,chroma_input=self.data['chroma_input'] if 'chroma_input' in self.data.keys() else None)
-            self.output_image = self.model.Output_Batch(within_0_1=True)
-            if self.model_training:
-                self.output_image = self.HR_unpadder(self.output_image)
-            if 'random' in self.objective:
-                if 'l1' in self.objective:
-                    data_in_loss_domain = self.output_image
-                elif 'VGG' in self.objective:
-                    data_in_loss_domain = self.model.netF(self.output_image)
-                Z_loss = torch.min((data_in_loss_domain.unsqueeze(0) - data_in_loss_domain.unsqueeze(1)).abs() + torch.eye(
-                        data_in_loss_domain.size(0)).unsqueeze(2).unsqueeze(3).unsqueeze(4).to(data_in_loss_domain.device), dim=0)[0]
-                if 'limited' in self.objective:
-                    rmse = (data_in_loss_domain - self.initial_image).abs()
-                    if z_iter==0:
-                        rmse_weight = 1*self.rmse_weight#*Z_loss.mean().item()/rmse.mean().item()
-                    Z_loss = Z_loss-rmse_weight*rmse
-                if self.Z_mask is not None:
-                    Z_loss = Z_loss*self.Z_mask
-                Z_loss = -1*Z_loss.mean(dim=(1,2,3))
-            elif any([phrase in self.objective for phrase in ['l1','scribble']]):
-                Z_loss = self.loss(self.output_image.to(self.device), self.desired_im.to(self.device))
-            elif 'desired_SVD' in self.objective:
-                Z_loss = self.loss({'SR':self.output_image.to(self.device)}).mean()
-            elif any([phrase in self.objective for phrase in ['hist','dict']]):
-                Z_loss = self.loss(self.output_image.to(self.device))
-                if 'localSTD' in self.objective:
-                    Z_loss = Z_loss+(self.STD_PRESERVING_WEIGHT*(self.Masked_STD(first_image_only=False)-self.initial_STD)**2).mean(0).to(self.device)
-            elif 'Adversarial' in self.objective:
-                Z_loss = self.loss(self.netD(self.model.DTE_net.HR_unpadder(self.output_image).to(self.device)),True)
-            elif 'STD' in self.objective and not any([phrase in self.objective for phrase in ['periodicity','TV']]):
-                Z_loss = self.Masked_STD(first_image_only=False)
-                if any([phrase in self.objective for phrase in ['increase', 'decrease']]):
-                    Z_loss = (Z_loss-self.desired_STD)**2
-                Z_loss = Z_loss.mean(0)
-            elif 'Mag' in self.objective:
-                values_2_return = []
-                for im_num in range(self.output_image.size(0)):
-                    values_2_return.append(((torch.sparse.mm(self.patch_extraction_map,self.output_image[im_num].mean(dim=0).view([-1, 1])).view(
-                        [self.PATCH_SIZE_4_STD ** 2, -1]) - self.desired_patches) ** 2).mean())
-                Z_loss = torch.stack(values_2_return,0)
-            elif 'periodicity' in self.objective:
-                Z_loss = self.PeriodicityLoss().to(self.device)
-                if 'Plus' in self.objective and self.PLUS_MEANS_STD_INCREASE:
-                    Z_loss = Z_loss+self.STD_PRESERVING_WEIGHT*((self.Masked_STD(first_image_only=False)-self.desired_STD)**2).mean()
-            elif 'TV' in self.objective:
-                Z_loss = (self.STD_PRESERVING_WEIGHT*(self.Masked_STD(first_image_only=False)-self.initial_STD)**2).mean(0)+TV_Loss(self.output_image * self.image_mask).to(self.device)
-            elif 'VGG' in self.objective:
-                Z_loss = self.loss(self.model.netF(self.output_image).to(self.device),self.GT_HR_VGG)
-            if 'max' in self.objective:
-                Z_loss = -1*Z_loss
+            if self.profiler is not None:
+                self.profiler.Start_Iteration(z_iter,self.generator_forwards)
+            reused_evaluation = [evaluation for evaluation in self.line_search_evaluations if torch.equal(evaluation[0],self.Z_model.Z.data)]
+            self.line_search_evaluations = []
+            if len(reused_evaluation)>0: # The Z was already evaluated by the previous step's line search
+                Z_loss,total_Z_loss = reused_evaluation[-1][1:3]
+                self.Z_model.Z.grad = reused_evaluation[-1][3]
+            else:
+                self.optimizer.zero_grad()
+                Z_loss,data_in_loss_domain = self.Per_Start_Z_Loss(cur_data,active_starts,frozen_starts,best_data_in_loss_domain,Uncomp_batch)
+                total_Z_loss = None
+            per_start_stopping = per_start_stopping and Z_loss.dim()>0
+            if per_start_stopping:
+                cur_starts = np.arange(num_starts) if active_starts is None else active_starts.cpu().numpy()
+                cur_Z_losses = 1*best_Z_losses # Frozen starts are represented by their best loss
+                cur_Z_losses[cur_starts] = Z_loss.detach().cpu().numpy()
+                improved = cur_Z_losses<best_Z_losses
+                best_Z_losses[improved] = cur_Z_losses[improved]
+                best_pre_tanh_Z[torch.from_numpy(improved).to(self.Z_model.Z.device)] = self.Z_model.Z.data[torch.from_numpy(improved).to(self.Z_model.Z.device)]
+                if 'random' in self.objective: # Keeping the outputs of the best Zs, for computing distances from frozen starts
+                    if best_data_in_loss_domain is None:
+                        best_data_in_loss_domain = data_in_loss_domain.detach().clone()
+                    improved_rows = torch.from_numpy(improved[cur_starts]).to(data_in_loss_domain.device)
+                    best_data_in_loss_domain[torch.from_numpy(cur_starts).to(data_in_loss_domain.device)[improved_rows]] = data_in_loss_domain.detach()[improved_rows]
+                best_Z_losses_history.append(1*best_Z_losses)
             cur_LR = self.optimizer.param_groups[0]['lr']
             if self.loggers is not None:
                 for logger_num,logger in enumerate(self.loggers):
-                    cur_value = Z_loss[logger_num].item() if Z_loss.dim()>0 else Z_loss.item()
+                    cur_value = cur_Z_losses[logger_num] if per_start_stopping else Z_loss[logger_num].item() if Z_loss.dim()>0 else Z_loss.item()
                     logger.print_format_results('val', {'epoch': 0, 'iters': z_iter, 'time': time.time(), 'model': '','lr': cur_LR, 'Z_loss': cur_value}, dont_print=True)
             if not self.model_training:
-                self.latest_Z_loss_values = [val.item() for val in Z_loss]
-            Z_loss = Z_loss.mean()
-            if self.non_local_Z_optimization:
-                # if z_iter==self.cur_iter: #First iteration:
-                #     self.constraining_loss_weight = 255/10*Z_loss.item()
-                Z_loss = Z_loss+self.constraining_loss_weight*self.constraining_loss(self.output_image.to(self.device))
-            Z_loss.backward()
-            self.loss_values.append(Z_loss.item())
-            self.optimizer.step()
+                self.latest_Z_loss_values = list(cur_Z_losses) if per_start_stopping else [val.item() for val in Z_loss]
+            self.Profile('logging')
+            # When per-start stopping, normalizing by the number of all starts, to keep per-start gradients unaffected by batch compaction:
+            reported_Z_loss = cur_Z_losses.mean()-Z_loss.sum().item()/num_starts if per_start_stopping else 0
+            if total_Z_loss is None:
+                Z_loss = self.Total_Z_Loss(Z_loss,num_starts if per_start_stopping else None)
+                Z_loss.backward()
+            else:
+                Z_loss = total_Z_loss
+            self.Profile('backward')
+            self.loss_values.append(Z_loss.item()+reported_Z_loss)
+            self.generator_forwards_history.append(self.generator_forwards)
+            self.Profile('logging')
+            if self.optimizer_backend=='LBFGS':
+                pre_step_Z = 1*self.Z_model.Z.data
+                self.optimizer.step(self.Line_Search_Closure(cur_data,Z_loss,Uncomp_batch))
+                if torch.equal(pre_step_Z,self.Z_model.Z.data):
+                    print('L-BFGS converged after %d iterations'%(z_iter-self.cur_iter+1))
+                    z_iter += 1
+                    break
+            else:
+                self.optimizer.step()
+            self.Profile('step')
+            if per_start_stopping:
+                if len(best_Z_losses_history)>convergence_window:
+                    previous_best_Z_losses = best_Z_losses_history[-1-convergence_window][cur_starts]
+                    converged = (previous_best_Z_losses-best_Z_losses[cur_starts])/np.abs(previous_best_Z_losses)<1e-2*self.LR
+                    if np.any(converged):
+                        active_starts = torch.from_numpy(cur_starts[np.logical_not(converged)]).to(self.Z_model.Z.device)
+                        frozen_starts = torch.from_numpy(np.setdiff1d(np.arange(num_starts),cur_starts[np.logical_not(converged)])).to(self.Z_model.Z.device)
+                        cur_data = dict([(key,self.Active_Starts_Batch(value,active_starts)) for key,value in self.data.items()])
+                if active_starts is not None: # Undoing optimizer steps (e.g. due to momentum) of frozen starts:
+                    self.Z_model.Z.data[frozen_starts] = best_pre_tanh_Z[frozen_starts]
+                    if active_starts.numel()==0:
+                        print('All %d starts converged after %d iterations'%(num_starts,z_iter-self.cur_iter+1))
+                        z_iter += 1
+                        break
             if self.scheduler is not None:
                 self.scheduler.step(Z_loss)
                 if cur_LR<=1.2*self.MIN_LR:
                     break
+            if self.iteration_callback is not None and self.iteration_callback(self):
+                z_iter += 1
+                break
             z_iter += 1
+        if self.profiler is not None:
+            self.profiler.End_Iteration(self.generator_forwards)
+            print('Z optimization profile (mean per iteration): ',', '.join(['%s: %.3e'%(key,value) for key,value in self.profiler.Summary().items()]))
+        if per_start_stopping: # Returning the best Z of each start:
+            self.Z_model.Z.data = best_pre_tanh_Z
+            self.latest_Z_loss_values = list(best_Z_losses)
         if 'Adversarial' in self.objective:
             self.model.netG.train(False) # Preventing image padding in the DTE code, to have the output fitD's input size
         if 'random' in self.objective and 'limited' in self.objective:
@@ -690,6 +1315,8 @@ class Z_optimizer():
         if not self.model_training:
             print('Final STDs: ',['%.3e'%(val.item()) for val in self.Masked_STD(first_image_only=False).mean(0)])
         self.cur_iter = z_iter+1
+        if self.Z_store_key is not None:
+            self.Z_store.Put(self.Z_store_key,*self.ReturnStatus())
         Z_2_return = self.Z_model.Return_Detached_Z()
         self.Manage_Model_Grad_Requirements(disable=False)
         if self.model_training:# Results of all optimization iterations were cropped, so I do another one without cropping and with Gradients computation (for model training)
@@ -707,26 +1334,56 @@ class Z_optimizer():
     # def Return_Interpolated_SubImage(self,image, grid):
     #     return torch.nn.functional.grid_sample(image, grid.repeat([image.size(0),1,1,1]))
 
+    def Stack_Periodicity_Grids(self):
+        # Concatenating the sampling grids of all shifted sub-images along the width axis, each padded to the largest grid size with points outside the image (which are sampled
+        # as zeros), so that all sub-images (and their masks) are sampled in a single grid_sample call. Each (+shift,-shift) pair of sub-images is weighted by its sign in the loss
+        # (negative for half periods) over its number of pixels:
+        pairs = [(pair,1) for pair in self.periodicity_points]+[(pair,-1) for pair in self.half_period_points if len(pair)>0]
+        grids = [grid for pair,sign in pairs for grid in pair]
+        self.periodicity_grid_size = np.max([list(grid.size()[1:3]) for grid in grids],0)
+        self.periodicity_grid = torch.cat([torch.nn.functional.pad(grid,(0,0,0,int(self.periodicity_grid_size[1])-grid.size(2),0,int(self.periodicity_grid_size[0])-grid.size(1)),
+            value=-2) for grid in grids],2)
+        self.periodicity_pair_weights = torch.tensor([sign/(pair[0].size(1)*pair[0].size(2)) for pair,sign in pairs]).type(self.periodicity_grid.dtype).to(self.periodicity_grid.device)
+
     def PeriodicityLoss(self):
         loss = 0 if 'Plus' in self.objective and self.PLUS_MEANS_STD_INCREASE else (self.STD_PRESERVING_WEIGHT*(self.Masked_STD(first_image_only=False)-self.initial_STD)**2).mean()
         image = self.output_image
         mask = self.image_mask.unsqueeze(0).unsqueeze(0)
-        for point_num,point in enumerate(self.periodicity_points):
-            if 'nonInt' in self.objective:
-                cur_mask = Return_Interpolated_SubImage(mask,point[0])*Return_Interpolated_SubImage(mask,point[1])
-                loss = loss + (cur_mask * (Return_Interpolated_SubImage(image, point[0]) - Return_Interpolated_SubImage(image,point[1])).abs()).mean(dim=(1, 2, 3))
-                if 'Plus' in self.objective and not self.PLUS_MEANS_STD_INCREASE:
-                    cur_half_cycle_mask = Return_Interpolated_SubImage(mask,self.half_period_points[point_num][0])*Return_Interpolated_SubImage(mask,self.half_period_points[point_num][1])
-                    loss = loss - (cur_half_cycle_mask * (Return_Interpolated_SubImage(image, self.half_period_points[point_num][0]) -\
-                        Return_Interpolated_SubImage(image,self.half_period_points[point_num][1])).abs()).mean(dim=(1, 2, 3))
-            else:
-                cur_mask = Return_Translated_SubImage(mask,point)*Return_Translated_SubImage(mask,-point)
-                loss = loss+(cur_mask*(Return_Translated_SubImage(image,point)-Return_Translated_SubImage(image,-point)).abs()).mean(dim=(1, 2, 3))
+        if 'nonInt' in self.objective:
+            # Sampling the image (with the mask as an additional channel) at all shifts at once, then splitting the samples to (+shift,-shift) pairs:
+            samples = Return_Interpolated_SubImage(torch.cat([image,mask.expand([image.size(0),1]+list(mask.size()[2:]))],1),self.periodicity_grid)
+            samples = samples.view(list(samples.size()[:3])+[-1,int(self.periodicity_grid_size[1])])
+            pair_masks = samples[:,-1:,:,0::2]*samples[:,-1:,:,1::2]
+            pair_sums = (pair_masks*(samples[:,:-1,:,0::2]-samples[:,:-1,:,1::2]).abs()).sum(dim=(1,2,4))
+            return loss+(pair_sums*self.periodicity_pair_weights.unsqueeze(0)).sum(1)/image.size(1)
+        for point in self.periodicity_points:
+            cur_mask = Return_Translated_SubImage(mask,point)*Return_Translated_SubImage(mask,-point)
+            loss = loss+(cur_mask*(Return_Translated_SubImage(image,point)-Return_Translated_SubImage(image,-point)).abs()).mean(dim=(1, 2, 3))
         return loss
 
     def ReturnStatus(self):
         return self.Z_model.PreTanhZ(),self.optimizer
 
+def Benchmark_Optimizer_Backends(model,backends=Z_optimizer.OPTIMIZER_BACKENDS,random_seed=0,**Z_optimizer_kwargs):
+    # Optimizing Z with each backend, starting from the same model state, and comparing the number of generator forwards needed for reaching the lowest loss reached by all backends.
+    # Z_optimizer_kwargs are the Z_optimizer arguments (other than the model and optimizer backend). Returns {backend:(generator forwards to reach that loss, total generator forwards, final loss)}:
+    initial_model_state = dict([(key,1*model.__dict__[key]) for key in ['model_input','fake_H','output_image'] if key in model.__dict__.keys()])
+    loss_values,generator_forwards = {},{}
+    for backend in backends:
+        model.__dict__.update(dict([(key,1*value) for key,value in initial_model_state.items()]))
+        torch.manual_seed(random_seed)
+        cur_Z_optimizer = Z_optimizer(model=model,optimizer_backend=backend,**Z_optimizer_kwargs)
+        cur_Z_optimizer.optimize()
+        loss_values[backend],generator_forwards[backend] = np.array(cur_Z_optimizer.loss_values),np.array(cur_Z_optimizer.generator_forwards_history)
+    model.__dict__.update(initial_model_state)
+    common_loss = max([np.min(loss_values[backend]) for backend in backends])
+    results = {}
+    for backend in backends:
+        results[backend] = (generator_forwards[backend][np.argmax(loss_values[backend]<=common_loss)],generator_forwards[backend][-1],loss_values[backend][-1])
+        print('%s: %d generator forwards to reach loss %.3e (%d iterations, %d forwards in total, final loss %.3e)'%(backend,results[backend][0],common_loss,
+            len(loss_values[backend]),results[backend][1],results[backend][2]))
+    return results
+
 # def IndexingHelper(index,negative=False):
 #     if negative:
 #         return index if index < 0 else None
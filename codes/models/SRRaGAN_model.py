@@ -48,6 +48,11 @@ class SRRaGANModel(BaseModel):
             CEM_conf = CEMnet.Get_CEM_Conf(opt['scale'])
             CEM_conf.sigmoid_range_limit = bool(opt['network_G']['sigmoid_range_limit'])
             CEM_conf.input_range = np.array(opt['range'])
+            for field in ['precision','reduced_precision_filters','channels_last']:# Optional precision and memory format policy for the generator wrapped by CEM
+                if opt['network_G'][field] is not None:
+                    setattr(CEM_conf,field,opt['network_G'][field])
+            if opt['network_G']['precomputation_cache_dir'] is not None:# Opting in for storing the CEM precomputed filters on disk
+                CEM_conf.precomputation_cache_dir = opt['network_G']['precomputation_cache_dir']
             if self.is_train:
                 assert train_opt['pixel_domain']=='HR' or not self.CEM_arch,'Why should I use CEM_arch AND penalize MSE in the LR domain?'
                 CEM_conf.decomposed_output = bool(opt['network_D']['decomposed_input'])
@@ -59,6 +64,13 @@ class SRRaGANModel(BaseModel):
                 self.CEM_net.WrapArchitecture_PyTorch(only_padders=True)
         self.netG = networks.define_G(opt,CEM=self.CEM_net,num_latent_channels=self.num_latent_channels)  # G
         self.netG.to(self.device)
+        if opt['test'] is not None and opt['test']['tiles_memory_budget_MB'] is not None:
+            # Tiled inference for large images. Unless set, the margin around each tile is the (conservative) generator's receptive field radius:
+            assert self.CEM_arch,'Tiled inference is only supported for the CEM architecture'
+            self.tiles_memory_budget_MB = opt['test']['tiles_memory_budget_MB']
+            self.tiles_margin_LR = opt['test']['tiles_margin_LR'] if opt['test']['tiles_margin_LR'] is not None else self.Generator_Margin_LR(self.netG)
+        else:
+            self.tiles_memory_budget_MB = None
         logs_2_keep = ['l_g_pix', 'l_g_fea', 'l_g_range', 'l_g_gan', 'l_d_real', 'l_d_fake','D_loss_STD','l_d_real_fake','l_g_highpass','l_g_shift_invariant',
                        'D_real', 'D_fake','D_logits_diff','psnr_val','D_update_ratio','LR_decrease','Correctly_distinguished','l_d_gp',
                        'l_e','l_g_optimalZ']+['l_g_latent_%d'%(i) for i in range(self.num_latent_channels)]
@@ -541,7 +553,11 @@ class SRRaGANModel(BaseModel):
         self.netG.eval()
         if prevent_grads_calc:
             with torch.no_grad():
-                self.fake_H = self.netG(self.model_input)
+                if self.tiles_memory_budget_MB is not None:
+                    self.fake_H = (self.netG.module if isinstance(self.netG,nn.DataParallel) else self.netG).Tiled_Forward(self.model_input,
+                        generator_margin_LR=self.tiles_margin_LR,memory_budget_MB=self.tiles_memory_budget_MB)
+                else:
+                    self.fake_H = self.netG(self.model_input)
         else:
             self.fake_H = self.netG(self.model_input)
         self.output_image = 1*self.fake_H
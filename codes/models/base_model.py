@@ -101,6 +101,16 @@ class BaseModel():
             strides.append(network.stride[0])
         return (kernel_sizes,strides)
 
+    def Generator_Margin_LR(self,network):
+        # Conservative bound on the generator's receptive field radius (in LR pixels), treating all convolutions (including those applied in the HR domain) as LR ones:
+        if isinstance(network, nn.DataParallel):
+            network = network.module
+        if 'generated_image_model' in network.__dir__():
+            network = network.generated_image_model
+        convs = [m for m in network.modules() if isinstance(m,nn.Conv2d)]
+        assert all([m.stride[0]==1 for m in convs]),'Strided convolutions are not supported'
+        return int(sum([m.dilation[0]*(m.kernel_size[0]-1)//2 for m in convs]))
+
     def calc_receptive_field(self,kernel_sizes, strides):
         assert len(kernel_sizes) == len(strides), 'Parameter lists must have same length'
         if strides[-1] > 1:
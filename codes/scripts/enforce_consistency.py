@@ -0,0 +1,40 @@
+# Enforcing consistency of SR images (e.g. produced by other SR methods) with their LR inputs, in batch. Run from the codes folder, e.g.:
+# python scripts/enforce_consistency.py -LR <LR folder or manifest file> -SR <SR folder> -out <output folder> -workers 8
+import argparse
+import csv
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from CEM.batch_consistency import Pairs_From_Folders,Pairs_From_Manifest,Enforce_Consistency_Batch,STATS_FIELDS
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-LR', type=str, required=True, help='LR images folder, or a manifest file with lines of the form LR_path,SR_path[,kernel]')
+parser.add_argument('-SR', type=str, default=None, help='SR images folder (matched to LR images by file name). Not used with a manifest file')
+parser.add_argument('-out', type=str, required=True, help='Output folder for the consistent images and the residual statistics file')
+parser.add_argument('-kernel', type=str, default=None, help='Downscaling kernel (.npy file path or cubic). Defaults to cubic')
+parser.add_argument('-workers', type=int, default=os.cpu_count(), help='Number of worker processes (0 for processing in the main process)')
+parser.add_argument('-lower_magnitude_bound', type=float, default=None, help='Override the CEM lower bound on hTh magnitude (e.g. 0.1 for large scale factors)')
+args = parser.parse_args()
+
+if os.path.isdir(args.LR):
+    assert args.SR is not None,'SR images folder should be given when LR images are given as a folder'
+    pairs = Pairs_From_Folders(args.LR,args.SR)
+else:
+    pairs = Pairs_From_Manifest(args.LR)
+start_time = time.time()
+os.makedirs(args.out,exist_ok=True)
+with open(os.path.join(args.out,'residual_stats.csv'),'w',newline='') as stats_file:
+    writer = csv.DictWriter(stats_file,fieldnames=STATS_FIELDS)
+    writer.writeheader()
+    failed_pairs = []
+    for i,stats in enumerate(Enforce_Consistency_Batch(pairs,args.out,kernel=args.kernel,num_workers=args.workers,lower_magnitude_bound=args.lower_magnitude_bound)):
+        writer.writerow(stats)
+        if stats['error'] is not None:
+            failed_pairs.append(stats['name'])
+            print('%d/%d %s: Failed (%s)'%(i+1,len(pairs),stats['name'],stats['error']))
+        else:
+            print('%d/%d %s: LR RMSE %.2e -> %.2e'%(i+1,len(pairs),stats['name'],stats['LR_RMSE_before'],stats['LR_RMSE_after']))
+print('Processed %d image pairs in %.1f seconds'%(len(pairs),time.time()-start_time))
+if len(failed_pairs)>0:
+    print('%d pairs failed: %s'%(len(failed_pairs),', '.join(failed_pairs)))
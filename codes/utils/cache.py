@@ -0,0 +1,30 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+class LRU_Cache:
+    # Thread-safe, size bounded cache. Cached arrays are made read-only, as they are shared by all callers. None values (e.g. failed computations) are not cached:
+    def __init__(self,max_size):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self,key,compute_func):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        value = compute_func()
+        if value is not None:
+            self.put(key,value)
+        return value
+
+    def put(self,key,value):
+        for array in (value if isinstance(value,tuple) else (value,)):
+            if isinstance(array,np.ndarray):
+                array.flags.writeable = False
+        with self.lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            while len(self.cache)>self.max_size:
+                self.cache.popitem(last=False)